@@ -10,15 +10,75 @@ from dash.exceptions import PreventUpdate
 # Import other modules
 import plotly.graph_objects as go
 import plotly.express as px
+from plotly.colors import hex_to_rgb
 import pandas as pd 
-import math
+import numpy as np
 import base64
 import io
+import os
+import struct
+import sys
+import tempfile
+import threading
+import time
+import uuid
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+import flask
+from werkzeug.utils import secure_filename
+
+#The CFD engine is shared with the command line script in the folder above
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from CFD_engine import BIN_SIZE, OUTPUT_FORMATS, SGR_DTYPES, SGR_INDEX_EXTENSION, SITE_DTYPES, SITE_OPTIONAL, WINDOW, CFDCancelled, ChromosomePool, MemoryLRU, PrefixIndex, RunStats, SgrCache, SiteIndex, bootstrap_cfd, cfd_by_group, cfd_for_window, decompress_head, memory_footprint, open_input, parse_rate, read_sites, read_table, run_phase, sniff_text, split_chromosomes, write_table
 
 
 
 app = dash.Dash(__name__, external_stylesheets=[dbc.themes.BOOTSTRAP])
 
+#Parsed sgr uploads are cached on disk as binary arrays so re-running the same files skips the parsing
+#The folder and maximum size (MB) can be set with the CFD_SGR_CACHE and CFD_SGR_CACHE_MB environment variables
+sgr_cache = SgrCache(
+    os.environ.get("CFD_SGR_CACHE", os.path.join(tempfile.gettempdir(), "CFD_sgr_cache")),
+    int(os.environ.get("CFD_SGR_CACHE_MB", 2048)) * 1024**2,
+)
+
+#Parsed uploads are also kept in memory (keyed by a hash of the upload contents) so each upload is only decoded
+#and parsed once between the validation and Update callbacks (memory budget set with CFD_UPLOAD_CACHE_MB)
+upload_cache = MemoryLRU(int(os.environ.get("CFD_UPLOAD_CACHE_MB", 1024)) * 1024**2)
+
+#Normalised result of each sgr file keyed by (sgr hash, site hash, window, bin size, rounding)
+#so re-running only computes the files whose inputs have changed
+result_cache = MemoryLRU(int(os.environ.get("CFD_RESULT_CACHE_MB", 256)) * 1024**2)
+
+#Per site matrix of each sgr file (for the heatmap and the groups) with the same keys, kept apart from the result cache
+#as they are much bigger (about 40 MB for 20000 sites) and losing one doesn't stop the normalised result being reused
+#The oldest are dropped past CFD_FINAL_CACHE_MB (the heatmap then says so rather than recomputing the file)
+final_cache = MemoryLRU(int(os.environ.get("CFD_FINAL_CACHE_MB", 1024)) * 1024**2)
+
+#Finished tables for downloading, the browser only holds the key (Stored_df) rather than the whole table as JSON
+#The oldest are dropped past CFD_STORED_RESULTS_MB (the graph then needs updating again before downloading)
+stored_results = MemoryLRU(int(os.environ.get("CFD_STORED_RESULTS_MB", 256)) * 1024**2)
+
+#Size (in pixels) the per site heatmap is drawn at, the matrix is averaged down to this on the server
+heatmap_height = 800
+heatmap_width = 1000
+
+#Bootstrap confidence bands (95%, resampling the sites with a fixed seed) when ticked, replicates set with CFD_BOOTSTRAP_REPLICATES
+bootstrap_replicates = int(os.environ.get("CFD_BOOTSTRAP_REPLICATES", 1000))
+
+#Processes the chromosomes of each sgr file are split across for the site lookup (set with CFD_CHROMOSOME_WORKERS,
+#1 turns it off and 0 uses every core), the chromosomes are put in shared memory for the workers
+chromosome_workers = int(os.environ.get("CFD_CHROMOSOME_WORKERS", 1))
+
+#Folder on the server that sgr and site files can be selected from instead of uploading them through the browser
+#(these are parsed straight from the file), set with the CFD_DATA_DIR environment variable
+data_dir = os.path.abspath(os.environ.get("CFD_DATA_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), "data")))
+
+#Background jobs for the Update button so long runs don't hold up the server (number of workers set with CFD_JOB_WORKERS)
+#Jobs are kept in this process so the app needs to run as a single (multi-threaded) server process
+job_pool = ThreadPoolExecutor(max_workers=int(os.environ.get("CFD_JOB_WORKERS", 2)))
+jobs = {}
+
 # Tab styles
 # ~ used in dcc.Tabs and dcc.Tab
 tabs_styles = {"height": "44px"}
@@ -59,8 +119,6 @@ The site files can have any extention (I probably should restrict that) and need
     * The strand the item (each row) is on 
     * Currently only accepts F or R notation 
         * *Will update that at some point*
-    * Also you currently need to have at least one forward and reverse stranded item
-        * *Also will update this*
 
 """
 mechanism_info="""
@@ -69,15 +127,16 @@ Its something like:\n
 1. Reads in the site file and rounds to the nearest multiple of 10
 	* This allows the site to be matched in the sgr file
 2. Creates a large for loop iterating over sgr files
-3. Slices the sgr file into seperate columns within a dictionary (hash table)
+3. Reads the sgr file into seperate chromosomes within a dictionary (hash table) of sorted position and read arrays
+	* The parsed arrays are cached on disk (memory-mapped) so re-running the same files skips this step
 	* This speeds up the processing
-4. Iterates over each row in the site file
-	* Determines the chromosome being used in the current iteration
-	* Finds the index that the site matches to within the chromosome 
-	* Creates a +/- 120 index window (1200 bp) and identifies the number of reads within each bin for that site
-    * These are appended to a forward or reverse strand list and the loop continues creating a large list of every site +/- 1200bp 
-5. The forward and reverse list are combined so that the strand direction is accounted for
-6. The normalisation value is calculated from the total number of reads divided by the bin window size (241)
+4. Finds every site of a chromosome at once
+	* Looks up all the sites (and every bin +/- 120 around them) in the sorted positions in one go
+	* Gathers the number of reads within each bin for every site into a single sites x 241 matrix
+	* Reverse strand rows are flipped so they run in the same direction as the forward strand rows
+5. The forward and reverse strand sites are combined into one table (forward first)
+	* Other window and bin sizes are summed from a cumulative sum index of each sgr file (built once per file)
+6. The normalisation value is calculated from the total number of reads divided by the number of bins in the window (241 for +/-1200bp in 10bp bins)
 7. The total sum of each bin is divided by the normalisation value to give the final values for each bin
 
 I can give no guarantee that this app will actually work or that whatever is produced has any meaning (but it probably does)
@@ -86,12 +145,10 @@ I can give no guarantee that this app will actually work or that whatever is pro
 
 other_info ="""
 ### Known Issues
-* Fails if the site file has either no Forward or no reverse Strand items
-    * It is rare for this to matter (but it might)
-* Only checks if the column length and F/R format is correct, if the data within it is misordered then it'll try and fail to run
+* Only checks the first lines of each file (column length, numbers and F/R format), if the data further in is misordered then it'll try and fail to run
     * This is to prevent the code disabling the button when the data might work but should probably be altered 
-* The files are "checked" when they are loaded which would be slow with many large files 
 * It seems to get stuck when inputting data sometimes on the web server and I'm not sure why (may just be a server issue)
+    * Update now runs in the background with a progress bar so long runs shouldn't time out the page
 
 ### Potentually adding
 Writing this on the actual app for a sense of imposing urgency
@@ -101,7 +158,6 @@ Writing this on the actual app for a sense of imposing urgency
     * Just make it easier to navigate when you inevitably make it overly complicated
 * Give info on the files loaded? 
     * The process already calculates bin values, chromosomes, total reads and normalisation value; These could just be returned
-* Give options for bin size 
 
 
 ### Added 
@@ -112,6 +168,22 @@ Writing this on the actual app for a sense of imposing urgency
 * 15/10/2021
     * Updated the input text so that they check their respective inputs individually (faster)
     * Updated the "Update" button so that it responds to the individual inputs (Only runs when input is probably correct)
+* 18/10/2026
+    * The files are checked from their first lines only so the upload panel responds straight away (the whole file is parsed when Update is pressed)
+    * The size and first chromosomes of each file are shown when they are loaded
+    * Site files no longer need both Forward and Reverse strand items
+    * Options for the window and bin size
+    * Update runs in the background with a progress bar and a Cancel button
+    * Large files can be selected from a data folder on the server (CFD_DATA_DIR) instead of uploading them through the browser
+        * and can be put there with a streaming upload (curl -T file.sgr http://<server>/upload/file.sgr) if CFD_ALLOW_UPLOAD is set
+    * The data can be downloaded as CSV, TSV (gzipped), parquet, feather or npz
+    * sgr and site files can be gzip or bgzip compressed (e.g. .sgr.gz or .sgr.bgz)
+    * Optional run statistics (time and memory of each phase for each file) in a panel under the graph
+    * Optional 95% confidence bands from resampling the sites (also added to the downloaded data)
+    * Heatmap tab of the reads of every site (drawn on the server and redrawn when zoomed in), sorted by total signal or strand then site file order
+    * The lines are drawn with WebGL so the graph stays quick with lots of libraries
+    * Large sgr files can be split by chromosome across processes (CFD_CHROMOSOME_WORKERS)
+    * Optional group column (5th) in the site file to plot a CFD line for each group of sites from the same run
 """
 
 
@@ -172,6 +244,19 @@ app.layout = html.Div(
                                                 # Allow multiple files to be uploaded
                                                 multiple=True
                                             ),
+                                            #Large files can be picked from the server data folder instead
+                                            dbc.Row(
+                                                [
+                                                    dbc.Col(
+                                                        dcc.Dropdown(id="server-sgr", options=[], multi=True, placeholder="Or select sgr files on the server"),
+                                                    ),
+                                                    dbc.Col(
+                                                        dbc.Button("Refresh", id="refresh_server_files", n_clicks=0, color="secondary", size="sm"),
+                                                        width={"size": "auto"},
+                                                    ),
+                                                ],
+                                                style={"width": "90%", "margin": "10px"},
+                                            ),
                                             dbc.Spinner( 
                                                 children = [                                            
                                                     html.Div(
@@ -212,6 +297,12 @@ app.layout = html.Div(
                                                     'margin': '10px'
                                                 },
                                             ),
+                                            dcc.Dropdown(
+                                                id="server-site",
+                                                options=[],
+                                                placeholder="Or select a site file on the server",
+                                                style={"width": "90%", "margin": "10px"},
+                                            ),
                                             dbc.Spinner( 
                                                 children = [
                                                     html.Div(
@@ -236,53 +327,147 @@ app.layout = html.Div(
                                 "margin-top": "10px",
                             }
                         ),
+                        dbc.Row(
+                            [
+                                dbc.Col(
+                                    [
+                                        html.Br(),
+                                        dbc.Button(
+                                            "Update",
+                                            id="update_button",
+                                            n_clicks = 0,
+                                            disabled=False,
+                                            color="secondary",
+                                            size= "lg"
+                                        )
+                                    ],
+                                    width={"size": "auto"},
+                                ),
+                                #Window and bin size (other sizes are made from a cumulative sum index of each sgr)
+                                dbc.Col(
+                                    [
+                                        html.Div("Window (+/- bp)"),
+                                        dbc.Input(id="window_input", type="number", value=1200, min=10, step=10),
+                                    ],
+                                    width={"size": 2},
+                                ),
+                                dbc.Col(
+                                    [
+                                        html.Div("Bin size (bp)"),
+                                        dbc.Input(id="bin_input", type="number", value=10, min=10, step=10),
+                                    ],
+                                    width={"size": 2},
+                                ),
+                                #Opt-in timing of each phase of the run (shown in the Run statistics panel under the graph)
+                                dbc.Col(
+                                    dbc.Checklist(
+                                        id="stats_options",
+                                        options=[
+                                            {"label": "Run statistics", "value": "time"},
+                                            {"label": "Trace memory (slower)", "value": "memory"},
+                                        ],
+                                        value=[],
+                                    ),
+                                    width={"size": "auto"},
+                                ),
+                                dbc.Col(
+                                    dbc.Checklist(
+                                        id="bootstrap_option",
+                                        options=[{"label": "95% confidence bands (bootstrap of the sites)", "value": "bootstrap"}],
+                                        value=[],
+                                    ),
+                                    width={"size": "auto"},
+                                ),
+                                dbc.Col(
+                                    dbc.Checklist(
+                                        id="group_option",
+                                        options=[{"label": "A line for each group of sites (5th column of the site file)", "value": "groups"}],
+                                        value=[],
+                                    ),
+                                    width={"size": "auto"},
+                                ),
+                            ],
+                            align="end",
+                        ),
+                        #Progress of the background job (polled by the interval while a job is running)
+                        dbc.Row(
+                            [
+                                dbc.Col(
+                                    [
+                                        dbc.Progress(id="job_progress", value=0, striped=True, animated=True),
+                                        html.Div(id="job_status"),
+                                    ],
+                                    width={"size": 6},
+                                ),
+                                dbc.Col(
+                                    [
+                                        dbc.Button(
+                                            "Cancel",
+                                            id="cancel_button",
+                                            n_clicks = 0,
+                                            disabled=True,
+                                            color="secondary",
+                                            size= "sm"
+                                        ),
+                                        dcc.Interval(id="job_poll", interval=500, disabled=True),
+                                        dcc.Store(id="job_id"),
+                                    ],
+                                    width={"size": "auto"},
+                                ),
+                            ],
+                            align="center",
+                            style={"margin-top": "10px"},
+                        ),
                         dbc.Row(
                             dbc.Col(
                                 [
-                                    html.Br(),
-                                    dbc.Button(
-                                        "Update",
-                                        id="update_button",
-                                        n_clicks = 0,
-                                        disabled=False,
-                                        color="secondary",
-                                        size= "lg"
-                                    )
+                                    dcc.Graph(id="graph"),
                                 ]
-                            )
+                            ),
                         ),
                         dbc.Row(
                             dbc.Col(
                                 [
-                                    dbc.Spinner(
-                                        children = [
-                                            dcc.Graph(id="graph"),
-                                        ],
-                                        type="border",
-                                        color="black",
-                                        size="lg",
-                                       # fullscreen=False
+                                    dbc.Button("Run statistics", id="stats_button", n_clicks=0, color="link"),
+                                    dbc.Collapse(
+                                        html.Div(id="run_stats", children="Tick Run statistics before pressing Update to time each phase of the run"),
+                                        id="stats_collapse",
+                                        is_open=False,
                                     ),
                                 ]
                             ),
                         ),
                         dbc.Row(
-                            dbc.Col(
-                                [
-                                    dbc.Button(
-                                        "Download data",
-                                        id="download_button",
-                                        n_clicks = 0,
-                                        disabled=False,
-                                        color="secondary",
-                                        size= "lg",
+                            [
+                                dbc.Col(
+                                    [
+                                        dbc.Button(
+                                            "Download data",
+                                            id="download_button",
+                                            n_clicks = 0,
+                                            disabled=False,
+                                            color="secondary",
+                                            size= "lg",
+                                        ),
+                                        dcc.Store(id="Stored_df"),
+                                        dcc.Store(id="Stored_sgr_input"),
+                                        dcc.Store(id="Stored_site_input"),
+                                        dcc.Download(id="download_df"),
+                                    ],
+                                    width={"size": "auto"},
+                                ),
+                                #Format of the downloaded table (parquet and feather need pyarrow on the server)
+                                dbc.Col(
+                                    dcc.Dropdown(
+                                        id="download_format",
+                                        options=[{"label": "CSV", "value": "csv"}] + [{"label": output_format, "value": output_format} for output_format in OUTPUT_FORMATS],
+                                        value="csv",
+                                        clearable=False,
                                     ),
-                                    dcc.Store(id="Stored_df"),
-                                    dcc.Store(id="Stored_sgr_input"),
-                                    dcc.Store(id="Stored_site_input"),
-                                    dcc.Download(id="download_df"),
-                                ]
-                            )
+                                    width={"size": 2},
+                                ),
+                            ],
+                            align="center",
                         ),
                                     
                         
@@ -290,6 +475,42 @@ app.layout = html.Div(
                     style=tab_style,
                     active_tab_style=tab_selected_style
                 ),
+                #Heatmap tab (the per site matrix is drawn into an image on the server and redrawn for the zoomed region)
+                dbc.Tab(
+                    label="Heatmap",
+                    children=[
+                        dbc.Row(
+                            [
+                                dbc.Col(
+                                    [
+                                        html.Div("Library"),
+                                        dcc.Dropdown(id="heatmap_library", options=[], clearable=False),
+                                    ],
+                                    width={"size": 4},
+                                ),
+                                dbc.Col(
+                                    [
+                                        html.Div("Sort sites by"),
+                                        dcc.Dropdown(
+                                            id="heatmap_sort",
+                                            options=[
+                                                {"label": "Total signal", "value": "total"},
+                                                {"label": "Strand then site file order", "value": "file"},
+                                            ],
+                                            value="total",
+                                            clearable=False,
+                                        ),
+                                    ],
+                                    width={"size": 3},
+                                ),
+                            ],
+                            style={"margin": "10px"},
+                        ),
+                        dcc.Graph(id="heatmap", style={"height": f"{heatmap_height}px"}),
+                    ],
+                    style=tab_style,
+                    active_tab_style=tab_selected_style
+                ),
                 #Tab 2
                 dbc.Tab(
                     label="Info",
@@ -359,158 +580,564 @@ app.layout = html.Div(
 ###Define functions to use in the callbacks
 
 
-#Function to read in the input data files
-def parse_contents(contents, filename,site=False):
+#Function to decode the base64 contents of an uploaded file to bytes
+def decode_contents(contents):
     content_type, content_string = contents.split(',')
 
-    decoded = base64.b64decode(content_string)
+    return base64.b64decode(content_string)
+
+
+#Function to decode only the start of an uploaded file (used to check the files quickly)
+#Returns the decoded bytes (decompressed if the file is gzip/bgzip), whether there is more of the file and the size of the whole file in MB
+def decode_head(contents, n_bytes=65536):
+    start = contents.index(',') + 1
+    end = min(len(contents), start + (n_bytes // 3) * 4)
+    size_mb = (len(contents) - start) * 3 / 4 / 1024**2
+
+    return decompress_head(base64.b64decode(contents[start:end])), end < len(contents), size_mb
+
+
+#Function to read in the input data files
+#Uses compact column types (categorical chromosomes and strands, int32 positions and float32 reads)
+#gzip and bgzip compressed files are decompressed as they are read, plain files are parsed straight from the decoded bytes
+def parse_contents(contents, filename,site=False):
+    decoded = open_input(io.BytesIO(decode_contents(contents)))
     if site == True:
-        df = pd.read_csv(io.StringIO(decoded.decode('utf-8')),sep="\t",header=None)
-        df.rename(columns={0:"chr",1:"gene",2:"site",3:"strand"},inplace=True)
+        df = read_table(decoded, SITE_DTYPES, optional=SITE_OPTIONAL)
 
         
     elif 'sgr' in filename:
-        df = pd.read_csv(io.StringIO(decoded.decode('utf-8')),sep="\t",header=None)
-        df.rename(columns={0:"chr",1:"site",2:"reads"},inplace=True)
+        df = read_table(decoded, SGR_DTYPES)
     else:
         False
+    print(f'{filename}: {parse_rate(df)}')
+
+    return df
+
+
+#Function to parse an sgr upload once, later calls with the same contents are taken from the upload cache
+#Returns its hash table of chromosomes
+def load_sgr_upload(contents, filename, key=None):
+    if key is None:
+        key = SgrCache.key_for_bytes(contents)
+    chromosomes = upload_cache.get(key)
+
+    if chromosomes is None:
+        chromosomes = sgr_cache.get(key)
+        if chromosomes is None:
+            chromosomes = split_chromosomes(parse_contents(contents, filename))
+            sgr_cache.put(key, chromosomes)
+        upload_cache.put(key, chromosomes)
+
+    return chromosomes
+
+
+#Function to parse a site file upload once
+def load_site_upload(contents, filename):
+    key = ("site", SgrCache.key_for_bytes(contents))
+    df = upload_cache.get(key)
+
+    if df is None:
+        df = parse_contents(contents, filename, site=True)
+        upload_cache.put(key, df)
 
     return df
 
 
+#Function to list the files in the data folder, returns the sgr files and the other (possible site) files
+def list_data_files():
+    if not os.path.isdir(data_dir):
+        return [], []
+
+    #(region indexes made with CFD_index.py are kept next to their sgr files and aren't listed)
+    filenames = sorted(entry.name for entry in os.scandir(data_dir) if entry.is_file() and not entry.name.startswith('.') and not entry.name.endswith(SGR_INDEX_EXTENSION))
+
+    return [filename for filename in filenames if 'sgr' in filename], [filename for filename in filenames if 'sgr' not in filename]
+
+
+#Function to get the path of a file in the data folder (names sent from the browser are checked so they can't leave it)
+def data_path(filename):
+    path = os.path.abspath(os.path.join(data_dir, filename))
+    if os.path.dirname(path) != data_dir or not os.path.isfile(path):
+        raise ValueError(f"{filename} is not in the data folder")
+
+    return path
+
+
+#Function to read only the start of a file in the data folder (returns the same as decode_head)
+def file_head(path, n_bytes=65536):
+    with open(path, 'rb') as handle:
+        head = handle.read(n_bytes)
+    size = os.path.getsize(path)
+
+    return decompress_head(head), size > n_bytes, size / 1024**2
+
+
+#Function to put the uploaded and server files together as a list of (filename, contents, path)
+#contents is None for files from the data folder and path is None for uploads
+def gather_inputs(filenames, contents, server_filenames):
+    inputs = [(filename, content, None) for filename, content in zip(filenames or [], contents or [])]
+    for filename in server_filenames or []:
+        inputs.append((filename, None, data_path(filename)))
+
+    return inputs
+
+
+#Function to get the start of an uploaded or server file
+def input_head(contents, path):
+    if path is None:
+        return decode_head(contents)
+
+    return file_head(path)
+
+
+#Function to load a site file from the data folder once
+def load_site_file(path):
+    key = ("site", SgrCache.key_for_file(path))
+    df = upload_cache.get(key)
+
+    if df is None:
+        df = read_sites(path)
+        upload_cache.put(key, df)
+
+    return df
+
+
+#Streaming upload into the data folder for files too big to go through the browser, e.g.
+#curl -T library.sgr http://<server>/upload/library.sgr
+#The file is written to disk in chunks as it arrives so it is never held in memory
+#Turned off unless the CFD_ALLOW_UPLOAD environment variable is set as it lets anyone who can reach the app write files
+@app.server.route("/upload/<filename>", methods=["PUT", "POST"])
+def upload_to_data_dir(filename):
+    if not os.environ.get("CFD_ALLOW_UPLOAD"):
+        flask.abort(404)
+    filename = secure_filename(filename)
+    if not filename:
+        flask.abort(400)
+
+    #Written to a hidden temporary file first so a half uploaded file is never listed
+    os.makedirs(data_dir, exist_ok=True)
+    handle, temp_path = tempfile.mkstemp(dir=data_dir, prefix='.upload_')
+    size = 0
+    try:
+        with os.fdopen(handle, 'wb') as temp_file:
+            while True:
+                chunk = flask.request.stream.read(1024**2)
+                if not chunk:
+                    break
+                temp_file.write(chunk)
+                size += len(chunk)
+        os.replace(temp_path, os.path.join(data_dir, filename))
+    except:
+        os.remove(temp_path)
+        raise
+
+    return f"{filename} saved to the data folder ({size / 1024**2:.1f} MB)\n"
+
+
+######Callbacks
+
+#Function that runs the CFD plotter for every sgr file (run in the background job pool)
+#Progress is reported through the job dict and the run stops part way through if the job is cancelled
+#Returns the normalised values of every file, their bootstrap confidence bands (None if bootstrap is False)
+#and the final_cache key of the per site matrix of each file (for the heatmap)
+#With groups the normalised values (and bands) are one column per file and group of sites instead
+def run_cfd(job, sgr_inputs, site_input, window_bp, window_bin, bootstrap=False, groups=False):
+    site_filename, site_contents, site_path = site_input
+    site_key = SgrCache.key_for_bytes(site_contents) if site_path is None else SgrCache.key_for_file(site_path)
+    site_index = None
+    all_normalised = []
+    all_intervals = []
+    all_final_keys = {}
+    all_finals = {}
+    stats = job["stats"]
+    
+    for i, (sgr_filename, sgr_contents, sgr_path) in enumerate(sgr_inputs):
+        if job["cancel"].is_set():
+            raise CFDCancelled()
+        job["progress"] = 100 * i / len(sgr_inputs)
+        job["status"] = f"Working with {sgr_filename} ({i + 1}/{len(sgr_inputs)})"
+
+        #Files with the same contents and settings as a previous run are taken from the result cache
+        sgr_key = SgrCache.key_for_bytes(sgr_contents) if sgr_path is None else SgrCache.key_for_file(sgr_path)
+        result_key = (sgr_key, site_key, window_bp, window_bin, "half_up")
+        #(the per site matrix is only needed again for the groups)
+        after_sum_normalised = result_cache.get(result_key)
+        final = final_cache.get(result_key) if groups else None
+        interval = result_cache.get(("bootstrap", bootstrap_replicates) + result_key) if bootstrap else None
+        all_final_keys[sgr_filename] = result_key
+        if after_sum_normalised is not None and (interval is not None or not bootstrap) and (final is not None or not groups):
+            print(f'Using the previous result for {sgr_filename}')
+            all_normalised.append(after_sum_normalised.rename(sgr_filename))
+            if groups:
+                all_finals[sgr_filename] = final
+            if bootstrap:
+                all_intervals.append(interval.set_axis([f"{sgr_filename}_lower", f"{sgr_filename}_upper"], axis=1))
+            continue
+
+        #open site file rounded to the nearest multiple of 10 (5 up method as not affected by floats)
+        #The site index is only built if a file needs computing and is then reused for every sgr file
+        if site_index is None:
+            site_index = load_run_sites(stats, site_input)
+
+        print (f'-----------------------------   \nCurrently working with {sgr_filename} ')
+
+        #Parsed once and then kept in the upload (or disk) cache
+        #files from the data folder are parsed straight into the disk cache
+        with run_phase(stats, sgr_filename, "load"):
+            if sgr_path is None:
+                chromosomes = load_sgr_upload(sgr_contents, sgr_filename, sgr_key)
+            else:
+                chromosomes = sgr_cache.load(sgr_path, sgr_key)
+
+        print (f'''Contains {sum(positions.size for positions, reads in chromosomes.values())} bin values
+Contains {len(chromosomes)} chromosomes 
+Uses {memory_footprint(chromosomes) / 1024**2:.1f} MB in memory ''')
+
+        #Find every site in the sgr file at once and gather the window of bins for each into a single matrix
+        #(bin sizes other than the sgr bins are summed from the prefix sum index, kept with the upload)
+        prefix_index = None
+        if window_bin != BIN_SIZE and chromosome_workers == 1:
+            prefix_index = upload_cache.get(("prefix", sgr_key))
+            if prefix_index is None:
+                with run_phase(stats, sgr_filename, "prefix_index"):
+                    prefix_index = PrefixIndex(chromosomes)
+                upload_cache.put(("prefix", sgr_key), prefix_index)
+
+        #Sites done within the file are added to the progress of the files before it
+        def progress(done, total, i=i):
+            if job["cancel"].is_set():
+                raise CFDCancelled()
+            job["progress"] = 100 * (i + done / total) / len(sgr_inputs)
+
+        if chromosome_workers == 1:
+            final, after_sum_normalised, total_reads, normalisation = cfd_for_window(chromosomes, site_index, sgr_filename, window_bp, window_bin, prefix_index, progress, stats)
+        else:
+            with run_phase(stats, sgr_filename, "shared_memory"):
+                chromosome_pool = ChromosomePool(chromosomes, chromosome_workers or None)
+            with chromosome_pool:
+                final, after_sum_normalised, total_reads, normalisation = cfd_for_window(chromosomes, site_index, sgr_filename, window_bp, window_bin, progress=progress, stats=stats, chromosome_pool=chromosome_pool)
+
+        print(f'The total amount of reads are {total_reads}\nThe normalisation number is {normalisation}')
+        
+        result_cache.put(result_key, after_sum_normalised)
+        final_cache.put(result_key, final)
+        all_normalised.append(after_sum_normalised)
+        if groups:
+            all_finals[sgr_filename] = final
+
+        #Confidence bands from resampling the sites of the per site matrix
+        if bootstrap:
+            with run_phase(stats, sgr_filename, "bootstrap"):
+                interval = bootstrap_cfd(final, bootstrap_replicates)
+            result_cache.put(("bootstrap", bootstrap_replicates) + result_key, interval)
+            all_intervals.append(interval.set_axis([f"{sgr_filename}_lower", f"{sgr_filename}_upper"], axis=1))
+        
+    #Reassembled from the new and cached columns
+    with run_phase(stats, "all files", "concat"):
+        all_normalised_together = pd.concat(all_normalised, axis=1)
+    all_intervals_together = pd.concat(all_intervals, axis=1) if bootstrap else None
+
+    #One profile per group from the per site matrices (also needs the site index if every file was cached)
+    if groups:
+        if site_index is None:
+            site_index = load_run_sites(stats, site_input)
+        all_normalised_together, all_intervals_together = group_profiles(stats, all_finals, site_index, bootstrap)
+    print('Finished processing')
+    job["progress"] = 100
+
+    return all_normalised_together, all_intervals_together, all_final_keys
+
+
+#Loads the site file of a run and builds its site index
+def load_run_sites(stats, site_input):
+    site_filename, site_contents, site_path = site_input
+    with run_phase(stats, site_filename, "site_index"):
+        site_df = load_site_upload(site_contents, site_filename) if site_path is None else load_site_file(site_path)
+        site_index = SiteIndex(site_df, BIN_SIZE, "half_up")
+    print(f'''The site file {site_filename} is being used
+        Contains: {site_index.forward.sum()} Forward strands and {site_index.reverse.sum()} Reverse strands ''')
+    return site_index
+
+
+#Function to make a column of normalised values for every file and group of sites ("file: group")
+#Bootstrap bands are resampled from the sites of each group so they match the lines
+def group_profiles(stats, all_finals, site_index, bootstrap=False):
+    if site_index.groups is None:
+        raise ValueError("The site file has no group column (5th column)")
+    profiles = {}
+    intervals = []
+    for sgr_filename, final in all_finals.items():
+        with run_phase(stats, sgr_filename, "groups"):
+            grouped = cfd_by_group(final, site_index, sgr_filename)
+        site_groups = site_index.groups[final.attrs['site_rows']]
+        for group, rows in grouped.groupby("group", sort=False):
+            name = f"{sgr_filename}: {group}"
+            profiles[name] = rows.set_index("distance")["normalised"].rename_axis(final.index.name)
+            if bootstrap:
+                with run_phase(stats, sgr_filename, "bootstrap"):
+                    interval = bootstrap_cfd(final.iloc[:, site_groups == group], bootstrap_replicates)
+                intervals.append(interval.set_axis([f"{name}_lower", f"{name}_upper"], axis=1))
+
+    return pd.DataFrame(profiles), pd.concat(intervals, axis=1) if bootstrap else None
+
+
+#Function to put a CFD run in the background job pool, returns the job ID
+def submit_job(*args, stats=None):
+    #Forget finished jobs whose results were never collected (e.g. the page was closed)
+    for old_id, old_job in list(jobs.items()):
+        if old_job["future"].done() and time.time() - old_job["submitted"] > 3600:
+            jobs.pop(old_id, None)
+
+    job_id = uuid.uuid4().hex
+    job = {"cancel": threading.Event(), "progress": 0, "status": "Waiting to start", "submitted": time.time(), "stats": stats}
+    job["future"] = job_pool.submit(run_cfd, job, *args)
+    if stats is not None:
+        job["future"].add_done_callback(lambda future: stats.stop())
+    jobs[job_id] = job
+
+    return job_id
+
+
+#Function to make the run statistics table (time and peak memory of each phase for each file)
+def make_stats_table(stats):
+    if stats is None:
+        return "Tick Run statistics before pressing Update to time each phase of the run"
+
+    df = stats.to_frame().groupby(["file", "phase"], sort=False).agg(seconds=("seconds", "sum"), peak_mb=("peak_mb", "max"))
+
+    return dbc.Table.from_dataframe(df.reset_index().round(3), striped=True, bordered=True, size="sm")
+
+
+#Function to make the graph from the normalised values (adds the Distance column used in the download)
+#The lines are drawn with WebGL (Scattergl) so the graph stays responsive with many libraries
+#The bootstrap confidence bands (if there are any) are shaded behind each line in the same colour
+def make_figure(all_normalised_together, all_intervals_together=None):
+    fig = px.line()
+    all_normalised_together.insert(0,"Distance",all_normalised_together.index)
+    colours = px.colors.qualitative.Plotly
+        
+    
+    for number, i in enumerate(all_normalised_together.columns.drop("Distance")):
+        colour = colours[number % len(colours)]
+        
+        # print(i)
+        # print(all_normalised_together[i])
+
+        if all_intervals_together is not None:
+            #Upper bound with no line then the lower bound filled up to it
+            fig.add_trace(go.Scattergl(
+                x=all_normalised_together["Distance"],
+                y=all_intervals_together[f"{i}_upper"],
+                mode="lines",
+                line={"width": 0},
+                legendgroup=i,
+                showlegend=False,
+                hoverinfo="skip",
+                ))
+            fig.add_trace(go.Scattergl(
+                x=all_normalised_together["Distance"],
+                y=all_intervals_together[f"{i}_lower"],
+                mode="lines",
+                line={"width": 0},
+                fill="tonexty",
+                fillcolor="rgba({}, {}, {}, 0.2)".format(*hex_to_rgb(colour)),
+                legendgroup=i,
+                showlegend=False,
+                hoverinfo="skip",
+                ))
+        
+        trace = go.Scattergl(
+            x=all_normalised_together["Distance"],
+            y=all_normalised_together[i],
+            mode="lines",
+            name= i,
+            line={"color": colour},
+            legendgroup=i,
+            )
+            
+        fig.add_trace(trace)
+        
+    fig.update_xaxes(title="Position from Site")
+    fig.update_yaxes(title="Normalised value")
+
+    return fig
+
+
+#Function to average a (sites x bins) matrix down to at most height x width pixels (blocks of sites and bins)
+def rasterise(values, height, width):
+    row_edges = np.linspace(0, values.shape[0], min(height, values.shape[0]) + 1).astype(int)
+    column_edges = np.linspace(0, values.shape[1], min(width, values.shape[1]) + 1).astype(int)
+    summed = np.add.reduceat(np.add.reduceat(values, row_edges[:-1], axis=0), column_edges[:-1], axis=1)
+
+    return summed / (np.diff(row_edges)[:, None] * np.diff(column_edges)[None, :])
+
+
+#Function to colour an image with the Viridis scale (0 to the 99th percentile so a few very high sites don't wash it out)
+def colour_image(image):
+    top = np.percentile(image, 99) if image.size else 0
+    scaled = np.clip(image / top, 0, 1) if top > 0 else np.zeros_like(image)
+    scale = np.array([hex_to_rgb(colour) for colour in px.colors.sequential.Viridis], dtype=float)
+    steps = np.linspace(0, 1, len(scale))
+
+    return np.stack([np.interp(scaled, steps, scale[:, channel]) for channel in range(3)], axis=-1).astype(np.uint8)
+
+
+#Function to encode an RGB image as a PNG data URI (written directly with zlib so no imaging library is needed)
+def png_data_uri(rgb):
+    height, width, _ = rgb.shape
+    raw = np.hstack([np.zeros((height, 1), dtype=np.uint8), rgb.reshape(height, width * 3)]).tobytes()
+
+    def chunk(kind, data):
+        return struct.pack(">I", len(data)) + kind + data + struct.pack(">I", zlib.crc32(kind + data))
+
+    png = b"\x89PNG\r\n\x1a\n" + chunk(b"IHDR", struct.pack(">IIBBBBB", width, height, 8, 2, 0, 0, 0)) + chunk(b"IDAT", zlib.compress(raw, 6)) + chunk(b"IEND", b"")
+    return "data:image/png;base64," + base64.b64encode(png).decode()
+
+
+#Function to make the heatmap of the per site matrix of a library (rows are sites, columns the distance from the site)
+#Only the region in x_range (bp) and y_range (site rows) is drawn, at screen resolution, so zooming redraws the region in full detail
+def make_heatmap(final, sort, x_range=None, y_range=None):
+    values = np.nan_to_num(final.to_numpy(dtype=np.float64).T)
+    if sort == "total":
+        values = values[np.argsort(-values.sum(axis=1), kind="stable")]
+    distances = final.index.to_numpy()
+    bin_bp = distances[1] - distances[0] if distances.size > 1 else BIN_SIZE
+
+    #Region to draw in rows and columns of the matrix (the axes are in bp and site rows)
+    if x_range is None:
+        x_range = [distances[0] - bin_bp / 2, distances[-1] + bin_bp / 2]
+    if y_range is None:
+        y_range = [values.shape[0] - 0.5, -0.5]
+    first_column = int(np.clip(np.floor((min(x_range) - distances[0]) / bin_bp + 0.5), 0, values.shape[1] - 1))
+    last_column = int(np.clip(np.ceil((max(x_range) - distances[0]) / bin_bp + 0.5), first_column + 1, values.shape[1]))
+    first_row = int(np.clip(np.floor(min(y_range) + 0.5), 0, max(values.shape[0] - 1, 0)))
+    last_row = int(np.clip(np.ceil(max(y_range) + 0.5), first_row + 1, max(values.shape[0], 1)))
+
+    fig = go.Figure()
+    region = values[first_row:last_row, first_column:last_column]
+    if region.size:
+        image = rasterise(region, heatmap_height, heatmap_width)
+        dx = (last_column - first_column) * bin_bp / image.shape[1]
+        dy = (last_row - first_row) / image.shape[0]
+        fig.add_trace(go.Image(
+            source=png_data_uri(colour_image(image)),
+            x0=distances[first_column] - bin_bp / 2 + dx / 2,
+            dx=dx,
+            y0=first_row - 0.5 + dy / 2,
+            dy=dy,
+            hoverinfo="x+y",
+            ))
+
+    fig.update_xaxes(title="Position from Site", range=list(x_range))
+    fig.update_yaxes(title=f"Site ({'sorted by total signal' if sort == 'total' else 'strand then site file order'})", range=list(y_range))
+    fig.update_layout(margin={"t": 30})
+
+    return fig
+
+
 ######Callbacks
 
 #Callback for the program (runs the CFD plotter)
+#The Update button submits a background job, the interval then polls it for progress until the result is ready
+#and the Cancel button stops the running job
 
 @app.callback(
     Output("graph", "figure"),
     Output("Stored_df", "data"),
+    Output("job_id", "data"),
+    Output("job_poll", "disabled"),
+    Output("job_progress", "value"),
+    Output("job_progress", "children"),
+    Output("job_status", "children"),
+    Output("cancel_button", "disabled"),
+    Output("run_stats", "children"),
     Input("update_button", "n_clicks"),
+    Input("job_poll", "n_intervals"),
+    Input("cancel_button", "n_clicks"),
     State("upload-data", "contents"),
     State("upload-data", "filename"),
     State('upload-data', 'last_modified'),
     State("upload-sites", "contents"),
-    State("upload-sites", "filename")
+    State("upload-sites", "filename"),
+    State("server-sgr", "value"),
+    State("server-site", "value"),
+    State("window_input", "value"),
+    State("bin_input", "value"),
+    State("stats_options", "value"),
+    State("bootstrap_option", "value"),
+    State("group_option", "value"),
+    State("job_id", "data"),
 )
 
-def update_output(n_clicks, sgr_contents, sgr_filenames, dates, site_contents, site_filename):
+def update_output(n_clicks, n_intervals, cancel_clicks, sgr_contents, sgr_filenames, dates, site_contents, site_filename, server_sgr, server_site, window_bp, window_bin, stats_options, bootstrap_option, group_option, job_id):
 
+    trigger = dash.callback_context.triggered[0]["prop_id"]
 
-    fig = px.line()
-    json_df = {}
-    
-    if sgr_filenames != None and site_contents != None:
-        site_input = parse_contents(site_contents, site_filename,site=True)
-        all_normalised_together =pd.DataFrame()
-        #open site file rounded to the nearest multiple of 10 (rounding method chosen here)
-        site_input.loc[:,'site'] = site_input.loc[:,'site'].apply(lambda x: (x+5)/10).apply(math.floor).apply(lambda x: x*10)   #Preferable 5 up method as not affected by floats
-
-        print(f'''The site file {site_filename} is being used
-        Contains: {(site_input.loc[:,'strand'] == 'F').sum()} Forward strands and {(site_input.loc[:,'strand'] == 'R').sum()} Reverse strands ''')
+    #Cancel the running job (the next poll picks up that it has stopped)
+    if trigger == "cancel_button.n_clicks":
+        if job_id in jobs:
+            jobs[job_id]["cancel"].set()
+        return dash.no_update, dash.no_update, dash.no_update, dash.no_update, dash.no_update, dash.no_update, "Cancelling", True, dash.no_update
 
-        
-        
-        
-        for i in range(len(sgr_contents)):
-            sgr_input = parse_contents(sgr_contents[i], sgr_filenames[i])
-            print (f'-----------------------------   \nCurrently working with {sgr_filenames[i]} ')
-    
-            #Forward and reverse strands made into opposite index arrays (121 is the 0 value)
-            #columns are specific genes, rows are reads at a particular distance from the site of that gene 
-            #First put into a list of Series as list.append is much more effiecent than pd.concat
-            collection_F = []
-            collection_R = []  
-            
-            #Fail counter for determining the strand direction (10 or more should break out of the loop for the sgr_file)
-            fails = 0
-    
-            print (f'''Contains {sgr_input.chr.count()} bin values
-Contains {len(sgr_input.loc[:,'chr'].unique())} chromosomes ''')
-
-            #Make a hash table (dict) of each chr slice from the sgr's
-            chromosomes={}
-            for chrom in sgr_input.chr.unique():
-                chromosomes.update({chrom:sgr_input[sgr_input.chr== chrom]})
-
-            #Iterate over each gene in site_input and find its location in the sgr file
-                     
-            for gene_index in range(site_input.index.size):
-                # print ('working with {} at number {}/{}'.format(site_input.iloc[gene_index,1],gene_index,site_input.index.size))    #Use while still slow
-                
-
-                #Specify which chromosome the current gene uses  
-                specific_chr = chromosomes[site_input.iloc[gene_index,0]]
-        
-                ## Get the index for the site within the specified chromosome indices 
-                
-                index_reads = specific_chr.index[specific_chr.site == site_input.iloc[gene_index,2]]        
-                
-                #Create a series with number of reads corresponding to the distance from the site (-1200 is index 0, 0 is index 121, 1200 is index 240)
-             
-                bin_reads = pd.Series(specific_chr.loc[index_reads[0]-120:index_reads[0]+120,'reads'])    
-                
-                bin_reads.name = site_input.iloc[gene_index,1]              #Make the column the genes name 
-                
-                #Concatinate bin_reads collumns with the appropriate collection (forward or reverse strand)
-                if site_input.iloc[gene_index,3] == 'F':
-                    # bin_reads.index = range(1200,-1210,-10)               #Used if index specified in original
-                    collection_F.append(bin_reads.reset_index(drop=True))
-                elif site_input.iloc[gene_index,3] == 'R':
-                    # bin_reads.index = range(-1200,+1210,10)               #Used if index specified in original
-                    collection_R.append(bin_reads.reset_index(drop=True))
-                else:
-                    print('Encountered strand direction that is not F or R')
-                    fails +=1
-                    if fails >= 10:
-                        break
-
-            #Convert the two collections(lists) of Series to a DataFrame and transpose it 
-            collection_F = pd.DataFrame(collection_F).T
-            collection_R = pd.DataFrame(collection_R).T
-            #Combine the two reads (opposite assignment results in reads being assigned for correct strand 
-            
-            collection_F.index=range(-1200,1210,10)
-            collection_R.index=range(1200,-1210,-10)
-            final = pd.concat([collection_F,collection_R],axis=1)
-            #Do sum and normalise 
-            total_reads = final.sum(axis=1).sum()
-            normalisation=total_reads/241
-            after_sum_normalised =final.sum(axis=1)/normalisation
-            after_sum_normalised.name=sgr_filenames[i]
-
-            print(f'The total amount of reads are {total_reads}\nThe normalisation number is {normalisation}')
-            
-            all_normalised_together = pd.concat([all_normalised_together,after_sum_normalised],axis=1)
-            
-        print('Finished processing')
-        all_normalised_together.insert(0,"Distance",range(-1200,1210,10))
-            
-        
-        for i in all_normalised_together.columns:
-            if i == "Distance":
-                continue
-            
-            # print(i)
-            # print(all_normalised_together[i])
-            
-            trace = go.Scatter(
-                x=all_normalised_together["Distance"],
-                y=all_normalised_together[i],
-                mode="lines",
-                name= i
-                )
-                
-            fig.add_trace(trace)
-            
-        json_df = all_normalised_together.to_json(date_format='iso', orient='split')
+    #Check on the running job
+    if trigger == "job_poll.n_intervals":
+        job = jobs.get(job_id)
+        if job is None:
+            return dash.no_update, dash.no_update, None, True, 0, "", "The job could not be found", True, dash.no_update
+        if not job["future"].done():
+            progress = round(job["progress"])
+            return dash.no_update, dash.no_update, dash.no_update, False, progress, f"{progress}%", job["status"], False, dash.no_update
 
+        jobs.pop(job_id, None)
+        try:
+            all_normalised_together, all_intervals_together, all_final_keys = job["future"].result()
+        except CFDCancelled:
+            return dash.no_update, dash.no_update, None, True, 0, "", "Cancelled", True, dash.no_update
+        except Exception as error:
+            return dash.no_update, dash.no_update, None, True, 0, "", f"The run failed: {error}", True, dash.no_update
+
+        fig = make_figure(all_normalised_together, all_intervals_together)
+        if all_intervals_together is not None:
+            all_normalised_together = all_normalised_together.join(all_intervals_together)
+        result_key = uuid.uuid4().hex
+        stored_results.put(result_key, all_normalised_together)
+        stored_results.put(("final", result_key), all_final_keys)
+        return fig, result_key, None, True, 100, "100%", "Finished", True, make_stats_table(job["stats"])
 
-            
+    fig = px.line()
     fig.update_xaxes(title="Position from Site")
     fig.update_yaxes(title="Normalised value")
 
-
-    return fig, json_df
+    #Empty inputs use the default +/-1200bp in 10bp bins
+    window_bp = int(window_bp) if window_bp else WINDOW * BIN_SIZE
+    window_bin = int(window_bin) if window_bin else BIN_SIZE
+    if window_bin <= 0 or window_bp % window_bin != 0:
+        fig.update_layout(title=f"The window ({window_bp}bp) needs to be a multiple of the bin size ({window_bin}bp)")
+        return fig, None, None, True, 0, "", "", True, dash.no_update
+    if window_bin % BIN_SIZE != 0:
+        fig.update_layout(title=f"The bin size ({window_bin}bp) needs to be a multiple of the sgr bin size ({BIN_SIZE}bp)")
+        return fig, None, None, True, 0, "", "", True, dash.no_update
+    
+    #A site file selected on the server is used instead of an uploaded one
+    #(a server file can have been removed or renamed since it was selected)
+    try:
+        sgr_inputs = gather_inputs(sgr_filenames, sgr_contents, server_sgr)
+        site_input = (server_site, None, data_path(server_site)) if server_site else (site_filename, site_contents, None)
+    except ValueError as error:
+        return fig, None, None, True, 0, "", str(error), True, dash.no_update
+
+    if trigger != "update_button.n_clicks" or not sgr_inputs or site_input[0] == None:
+        return fig, None, None, True, 0, "", "", True, dash.no_update
+
+    #Stop the previous job if Update is pressed again while it is running
+    if job_id in jobs:
+        jobs[job_id]["cancel"].set()
+
+    #Run statistics are only recorded when ticked
+    stats = RunStats("memory" in stats_options) if stats_options else None
+    job_id = submit_job(sgr_inputs, site_input, window_bp, window_bin, bool(bootstrap_option), bool(group_option), stats=stats)
+    return dash.no_update, dash.no_update, job_id, False, 0, "0%", "Waiting to start", False, dash.no_update
 
 #Callback for the sgr input and text
 
@@ -518,11 +1145,12 @@ Contains {len(sgr_input.loc[:,'chr'].unique())} chromosomes ''')
     Output("SGR_file_text", "children"),
     Output("Stored_sgr_input", "data"),
     Input ("upload-data", "filename"),
+    Input ("server-sgr", "value"),
     State("upload-data", "contents"),
 
 )
 
-def update_SGR_filenames(sgr_filenames, sgr_contents):
+def update_SGR_filenames(sgr_filenames, server_sgr, sgr_contents):
 
     #Default parameters 
     sgr_file_string = "No files currently loaded"
@@ -530,26 +1158,37 @@ def update_SGR_filenames(sgr_filenames, sgr_contents):
     input_validity_list=[]
 
     #Iterate over sgr_files and determine if they are validish
-    if sgr_filenames != None:
-        sgr_file_string=f"There are {len(sgr_filenames)} files being used: \n"
+    try:
+        sgr_inputs = gather_inputs(sgr_filenames, sgr_contents, server_sgr)
+    except ValueError as error:
+        return str(error), False
 
-        for i in range(len(sgr_contents)):
+    if sgr_inputs:
+        sgr_file_string=f"There are {len(sgr_inputs)} files being used: \n"
+
+        for sgr_filename, contents, path in sgr_inputs:
             try:
-                current_file = parse_contents(sgr_contents[i], sgr_filenames[i])
-                current_file.rename(columns={0:"chr",1:"site",2:"reads"},inplace=True)
+                #Only the first lines are checked here, the whole file is parsed when Update is pressed
+                if 'sgr' not in sgr_filename:
+                    raise ValueError(f"{sgr_filename} is not an sgr file")
+                head, truncated, size_mb = input_head(contents, path)
+                info = sniff_text(head.decode('utf-8', errors='replace'), truncated=truncated)
                 
-                current_file_length = len(current_file.columns)
+                current_file_length = info["columns"]
                 
-                if current_file_length != 3:
-                    sgr_file_string = sgr_file_string + f"The file {sgr_filenames[i]} has {current_file_length} columns when it should have 3 \n"
+                if current_file_length != 3 or not info["consistent"]:
+                    sgr_file_string = sgr_file_string + f"The file {sgr_filename} has {current_file_length} columns when it should have 3 \n"
+                    input_validity_list.append(False)
+                elif not info["numeric"]:
+                    sgr_file_string = sgr_file_string + f"The file {sgr_filename} has positions or reads (2nd and 3rd columns) that are not numbers \n"
                     input_validity_list.append(False)
                 else:
-                    sgr_file_string = sgr_file_string + f"{sgr_filenames[i]} \n"
+                    sgr_file_string = sgr_file_string + f"{sgr_filename} ({size_mb:.1f} MB, starts with {', '.join(info['chromosomes'])}) \n"
                     input_validity_list.append(True)
         
             except:
-                print (sgr_filenames[i])
-                sgr_file_string = sgr_file_string + f"The file {sgr_filenames[i]} cannot be loaded (wrong extention?) \n"
+                print (sgr_filename)
+                sgr_file_string = sgr_file_string + f"The file {sgr_filename} cannot be loaded (wrong extention?) \n"
                 input_validity_list.append(False)
             
         if all(input_validity_list) == True:
@@ -564,10 +1203,11 @@ def update_SGR_filenames(sgr_filenames, sgr_contents):
     Output("Site_file_text", "children"),
     Output("Stored_site_input", "data"),
     Input ("upload-sites", "filename"),
+    Input ("server-site", "value"),
     State("upload-sites", "contents"),
 )
 
-def update_SGR_filenames(site_filename, site_contents):
+def update_SGR_filenames(site_filename, server_site, site_contents):
 
     #Default parameters
     site_file_string = "No file currently loaded"
@@ -575,23 +1215,34 @@ def update_SGR_filenames(site_filename, site_contents):
     
     #Determine if the site file is valid
         
+    #A site file selected on the server is used instead of an uploaded one
+    if server_site:
+        site_filename = server_site
+
     if site_filename != None:
         try:
-            site_file_df = parse_contents(site_contents, site_filename,site=True)
+            #Only the first lines are checked here, the whole file is parsed when Update is pressed
+            head, truncated, size_mb = file_head(data_path(server_site)) if server_site else decode_head(site_contents)
+            info = sniff_text(head.decode('utf-8', errors='replace'), site=True, truncated=truncated)
             
-            site_file_length= len(site_file_df.columns)
+            site_file_length= info["columns"]
             
             #Check the number of columns is correct
-            if site_file_length != 4:
-                site_file_string = f"The site file has {site_file_length} columns when it should have 4"
+            if site_file_length not in (4, 5) or not info["consistent"]:
+                site_file_string = f"The site file has {site_file_length} columns when it should have 4 (or 5 with a group column)"
                 
             #Check the strand column is in F/R configuration (sets are unique and unorderdered so work for this purpose)
-            elif set(site_file_df.iloc[:,3].unique()) != {"F","R"}:
+            elif not set(info["strands"]) <= {"F","R"}:
                 site_file_string = f"The site file {site_filename} has the incorrect strand column (4th)\n\
                                     This column needs to be in the F/R format"
+
+            elif not info["numeric"]:
+                site_file_string = f"The site file {site_filename} has sites (3rd column) that are not numbers"
                 
             else:
-                site_file_string = f"The site file loaded is: \n{site_filename}"
+                site_file_string = f"The site file loaded is: \n{site_filename} ({size_mb:.1f} MB, starts with {', '.join(info['chromosomes'])})"
+                if site_file_length == 5:
+                    site_file_string += "\nThe 5th column is used as the group of each site"
                 site_file_validity = True
             
     
@@ -600,6 +1251,89 @@ def update_SGR_filenames(site_filename, site_contents):
 
     return site_file_string, site_file_validity
 
+#Callback to list the libraries of the last run in the heatmap tab
+
+@app.callback(
+    Output("heatmap_library", "options"),
+    Output("heatmap_library", "value"),
+    Input ("Stored_df", "data"),
+)
+
+def update_heatmap_libraries(data):
+
+    all_final_keys = stored_results.get(("final", data)) if data else None
+    if not all_final_keys:
+        return [], None
+
+    return [{"label": library, "value": library} for library in all_final_keys], next(iter(all_final_keys))
+
+#Heatmap callback, redrawn for the zoomed region when the graph is zoomed (or in full when it is reset)
+
+@app.callback(
+    Output("heatmap", "figure"),
+    Input ("heatmap_library", "value"),
+    Input ("heatmap_sort", "value"),
+    Input ("heatmap", "relayoutData"),
+    State("Stored_df", "data"),
+)
+
+def update_heatmap(library, sort, relayout, data):
+
+    all_final_keys = stored_results.get(("final", data)) if data else None
+    if not all_final_keys or library not in all_final_keys:
+        fig = go.Figure()
+        fig.update_layout(title="Press Update on the CFD tab to make the heatmap")
+        return fig
+
+    #The per site matrix can have been dropped from the cache since the run (past CFD_FINAL_CACHE_MB)
+    final = final_cache.get(all_final_keys[library])
+    if final is None:
+        fig = go.Figure()
+        fig.update_layout(title=f"The reads of each site of {library} are no longer kept, a bigger CFD_FINAL_CACHE_MB keeps more of them for the heatmap")
+        return fig
+
+    #Only a zoom uses the visible region, changing the library or sorting (or resetting the axes) draws everything
+    x_range = y_range = None
+    trigger = dash.callback_context.triggered[0]["prop_id"]
+    if trigger == "heatmap.relayoutData" and relayout:
+        if "xaxis.range[0]" in relayout:
+            x_range = [relayout["xaxis.range[0]"], relayout["xaxis.range[1]"]]
+        if "yaxis.range[0]" in relayout:
+            y_range = [relayout["yaxis.range[0]"], relayout["yaxis.range[1]"]]
+        if x_range is None and y_range is None and not any(key.endswith("autorange") for key in relayout):
+            raise PreventUpdate
+
+    return make_heatmap(final, sort, x_range, y_range)
+
+#Callback to show or hide the run statistics panel
+
+@app.callback(
+    Output("stats_collapse", "is_open"),
+    Input ("stats_button", "n_clicks"),
+    State("stats_collapse", "is_open"),
+)
+
+def toggle_stats(n_clicks, is_open):
+
+    if n_clicks:
+        return not is_open
+
+    return is_open
+
+#Callback to list the files in the server data folder (on loading the page and when Refresh is pressed)
+
+@app.callback(
+    Output("server-sgr", "options"),
+    Output("server-site", "options"),
+    Input ("refresh_server_files", "n_clicks"),
+)
+
+def update_server_files(n_clicks):
+
+    sgr_files, site_files = list_data_files()
+
+    return [{"label": filename, "value": filename} for filename in sgr_files], [{"label": filename, "value": filename} for filename in site_files]
+
 #Controlling the button usability depending on the input files 
 
 @app.callback(
@@ -636,16 +1370,19 @@ def update_button(sgr_input,site_input):
 @app.callback(
 Output( "download_df", "data"),
 Input ("download_button", "n_clicks"),
-State("Stored_df", "data")
+State("Stored_df", "data"),
+State("download_format", "value"),
 )
 
-def download_df(n_clicks, data):
+def download_df(n_clicks, data, download_format):
 
-    if data == None or data == {}:
-        df = pd.DataFrame([[1,3],[2,4]])
+    #The table is taken straight from the server side store
+    df = stored_results.get(data) if data else None
+    if df is None:
         raise PreventUpdate
-    else:
-        df = pd.read_json(data, orient='split')
+
+    if download_format in OUTPUT_FORMATS:
+        return dcc.send_bytes(lambda buffer: write_table(df, buffer, download_format), "mydf." + download_format)
     
     return dcc.send_data_frame(df.to_csv, "mydf.csv")
 
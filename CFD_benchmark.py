@@ -0,0 +1,229 @@
+#CFD Benchmark
+#Makes synthetic genome wide .sgr and site files of a chosen size and times each stage of the CFD
+#(the same engine functions used by CFD_plotter_in_progress_current.py and the app's Update button)
+#Used as 'python CFD_benchmark.py --bins 1000000 --sites 10000' from the command line
+#Lists of sizes (e.g. --bins 100000 1000000 10000000) are run as a grid so the scaling can be charted
+#Results are saved as JSON (and CSV) and can be compared with an earlier run with --compare to catch slow downs
+
+#Memory is the peak traced by tracemalloc during each stage (numpy arrays are traced but the internal
+#buffers of the pandas csv parser are not) and the maximum resident size of the process at the end of the stage
+#Tracing slows down the stages that make a lot of python objects (e.g. writing text) so use --no-trace for timings
+#that are closer to a normal run
+
+
+#import modules
+import argparse
+import base64
+import gc
+import itertools
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+import pandas as pd
+
+from CFD_engine import BIN_SIZE, PrefixIndex, SgrCache, SgrRegionIndex, SiteIndex, cfd_for_window, read_sgr, read_sgr_near_sites, read_sgr_regions, read_sites, split_chromosomes, write_table
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+#The app's upload parsing is timed too if dash is installed
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'App_version'))
+try:
+    import CFD_app
+except ImportError:
+    CFD_app = None
+
+
+#Writes a synthetic sgr file, every chromosome has bins_per_chromosome bins of bin_size bp with Poisson reads
+#Written a chromosome at a time so the file can be bigger than the memory used to make it
+def make_sgr(path, n_chromosomes, bins_per_chromosome, bin_size=BIN_SIZE, mean_reads=2.0, seed=0):
+    rng = np.random.default_rng(seed)
+    positions = np.arange(bins_per_chromosome, dtype=np.int64) * bin_size
+    with open(path, 'w') as handle:
+        for number in range(1, n_chromosomes + 1):
+            reads = rng.poisson(mean_reads, bins_per_chromosome)
+            pd.DataFrame({'chr': f'chr{number}', 'site': positions, 'reads': reads}).to_csv(handle, sep='\t', header=False, index=False)
+
+
+#Writes a synthetic site file of n_sites sites spread at random over the chromosomes of make_sgr
+#forward_fraction of the sites are on the F strand and the rest on the R strand
+def make_sites(path, n_chromosomes, bins_per_chromosome, n_sites, forward_fraction=0.5, bin_size=BIN_SIZE, seed=1):
+    rng = np.random.default_rng(seed)
+    chromosomes = rng.integers(1, n_chromosomes + 1, n_sites)
+    sites = rng.integers(0, bins_per_chromosome * bin_size, n_sites)
+    strands = np.where(rng.random(n_sites) < forward_fraction, 'F', 'R')
+    pd.DataFrame({
+        'chr': [f'chr{number}' for number in chromosomes],
+        'gene': [f'gene{number}' for number in range(n_sites)],
+        'site': sites,
+        'strand': strands,
+    }).to_csv(path, sep='\t', header=False, index=False)
+
+
+#Maximum resident size of the process so far in MB (None where resource isn't available, e.g. Windows)
+def max_rss_mb():
+    if resource is None:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    #Linux reports kB and macOS reports bytes
+    return rss / 1024**2 if sys.platform == 'darwin' else rss / 1024
+
+
+#Runs one stage and adds its time and memory to results, returns what the stage returns
+#(peak_mb is None if tracemalloc isn't running)
+def run_stage(results, settings, stage, function, *args, **kwargs):
+    gc.collect()
+    tracing = tracemalloc.is_tracing()
+    if tracing:
+        tracemalloc.reset_peak()
+        start_memory = tracemalloc.get_traced_memory()[0]
+    start = time.perf_counter()
+    output = function(*args, **kwargs)
+    seconds = time.perf_counter() - start
+    peak_mb = (tracemalloc.get_traced_memory()[1] - start_memory) / 1024**2 if tracing else None
+
+    results.append(dict(settings, stage=stage, seconds=seconds, peak_mb=peak_mb, max_rss_mb=max_rss_mb()))
+    print(f'{stage:<20}{seconds:>10.3f} s' + (f'{peak_mb:>10.1f} MB' if tracing else ''))
+    return output
+
+
+#Times every stage for one size of sgr and site file
+def benchmark(data_dir, settings, window_bp=1200, window_bin=10, other_bin=50):
+    sgr_file = os.path.join(data_dir, f'bench_{settings["chromosomes"]}x{settings["bins_per_chromosome"]}.sgr')
+    site_file = os.path.join(data_dir, f'bench_{settings["sites"]}_{settings["forward_fraction"]}.txt')
+    if not os.path.exists(sgr_file):
+        make_sgr(sgr_file, settings['chromosomes'], settings['bins_per_chromosome'])
+    if not os.path.exists(site_file):
+        make_sites(site_file, settings['chromosomes'], settings['bins_per_chromosome'], settings['sites'], settings['forward_fraction'])
+    settings = dict(settings, sgr_mb=os.path.getsize(sgr_file) / 1024**2)
+    results = []
+
+    print(f'-----------------------------   \n{settings}')
+
+    #Site file and sgr file loading (whole file, then streaming only the bins near sites)
+    site_index = run_stage(results, settings, 'site_index', lambda: SiteIndex(read_sites(site_file)))
+    sgr_input = run_stage(results, settings, 'read_sgr', read_sgr, sgr_file)
+    run_stage(results, settings, 'read_sgr_pandas', read_sgr, sgr_file, engine='pandas')
+    chromosomes = run_stage(results, settings, 'split_chromosomes', split_chromosomes, sgr_input)
+    del sgr_input
+    run_stage(results, settings, 'read_streaming', read_sgr_near_sites, sgr_file, site_index, (window_bp + other_bin) // BIN_SIZE)
+
+    #Region index (building it then reading only the parts of the file near the sites)
+    region_index = run_stage(results, settings, 'region_index', SgrRegionIndex.build, sgr_file)
+    run_stage(results, settings, 'read_regions', read_sgr_regions, sgr_file, site_index, (window_bp + other_bin) // BIN_SIZE, region_index)
+
+    #Binary sgr cache (writing the arrays then memory-mapping them back)
+    with tempfile.TemporaryDirectory() as cache_dir:
+        sgr_cache = SgrCache(cache_dir)
+        key = SgrCache.key_for_file(sgr_file)
+        run_stage(results, settings, 'cache_write', sgr_cache.put, key, chromosomes)
+        run_stage(results, settings, 'cache_read', sgr_cache.get, key)
+
+    #The CFD itself, directly gathered bins and bins summed from the prefix index
+    final, after_sum_normalised, total_reads, normalisation = run_stage(results, settings, 'cfd_gather', cfd_for_window, chromosomes, site_index, 'bench', window_bp, window_bin)
+    prefix_index = run_stage(results, settings, 'prefix_index', PrefixIndex, chromosomes)
+    run_stage(results, settings, 'cfd_prefix', cfd_for_window, chromosomes, site_index, 'bench', window_bp, other_bin, prefix_index)
+
+    #Writing the per site matrix
+    with tempfile.TemporaryDirectory() as out_dir:
+        run_stage(results, settings, 'write_tsv', write_table, final, os.path.join(out_dir, 'final'), 'tsv')
+
+    #The app's path (decoding the base64 upload and parsing it)
+    if CFD_app is not None:
+        with open(sgr_file, 'rb') as handle:
+            contents = 'data:application/octet-stream;base64,' + base64.b64encode(handle.read()).decode()
+        upload = run_stage(results, settings, 'app_parse', CFD_app.parse_contents, contents, os.path.basename(sgr_file))
+        run_stage(results, settings, 'app_split', split_chromosomes, upload)
+        del contents, upload
+
+    return results
+
+
+#Median time of each stage and size from a list of results
+def summarise(results):
+    df = pd.DataFrame(results)
+    keys = ['chromosomes', 'bins_per_chromosome', 'sites', 'forward_fraction', 'traced', 'stage']
+    return df.groupby(keys, sort=False)[['seconds', 'peak_mb']].median()
+
+
+#Prints the stages that are more than tolerance slower than in an earlier results file, returns True if any are
+#(or if no stages match, e.g. different sizes or a --no-trace run against a traced one, as nothing was compared)
+def compare(results, previous_file, tolerance):
+    with open(previous_file) as handle:
+        previous = summarise(json.load(handle)['results'])
+    current = summarise(results)
+    both = current.join(previous, rsuffix='_previous', how='inner')
+    slower = both[both['seconds'] > both['seconds_previous'] * (1 + tolerance)]
+
+    print(f'-----------------------------   \nCompared with {previous_file} ({len(both)} stages in both)')
+    if both.empty:
+        print('No stages match the earlier results (the sizes and --no-trace need to be the same), nothing was compared')
+        return True
+    for key, row in slower.iterrows():
+        print(f'Slower: {key} {row["seconds_previous"]:.3f} s -> {row["seconds"]:.3f} s')
+    if slower.empty:
+        print(f'No stages are more than {tolerance:.0%} slower')
+    return not slower.empty
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the CFD plotter on synthetic sgr and site files')
+    parser.add_argument('--chromosomes', type=int, nargs='+', default=[3], help='number of chromosomes')
+    parser.add_argument('--bins', type=int, nargs='+', default=[1000000], help='bins per chromosome')
+    parser.add_argument('--sites', type=int, nargs='+', default=[10000], help='number of sites')
+    parser.add_argument('--forward-fraction', type=float, nargs='+', default=[0.5], help='fraction of sites on the F strand')
+    parser.add_argument('--repeats', type=int, default=1, help='times each size is run')
+    parser.add_argument('--data-dir', help='folder to keep the synthetic files in (a temporary folder by default)')
+    parser.add_argument('--out', default='benchmark_results.json', help='JSON results file (a .csv of the same name is also written)')
+    parser.add_argument('--compare', help='earlier results file to compare with (exits with 1 if a stage is slower or no stages match)')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='fraction slower than the earlier results allowed')
+    parser.add_argument('--no-trace', action='store_true', help='time without tracing memory (peak_mb is left empty)')
+    args = parser.parse_args()
+
+    temp_dir = None
+    if args.data_dir is None:
+        temp_dir = tempfile.TemporaryDirectory()
+        data_dir = temp_dir.name
+    else:
+        data_dir = args.data_dir
+        os.makedirs(data_dir, exist_ok=True)
+
+    if not args.no_trace:
+        tracemalloc.start()
+    results = []
+    sizes = itertools.product(args.chromosomes, args.bins, args.sites, args.forward_fraction, range(args.repeats))
+    for chromosomes, bins, sites, forward_fraction, repeat in sizes:
+        settings = {'chromosomes': chromosomes, 'bins_per_chromosome': bins, 'sites': sites, 'forward_fraction': forward_fraction, 'repeat': repeat, 'traced': not args.no_trace}
+        results.extend(benchmark(data_dir, settings))
+    tracemalloc.stop()
+
+    if temp_dir is not None:
+        temp_dir.cleanup()
+
+    environment = {
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'pandas': pd.__version__,
+        'machine': platform.machine(),
+        'cpus': os.cpu_count(),
+    }
+    with open(args.out, 'w') as handle:
+        json.dump({'environment': environment, 'results': results}, handle, indent=1)
+    pd.DataFrame(results).to_csv(os.path.splitext(args.out)[0] + '.csv', index=False)
+    print(f'-----------------------------   \n{summarise(results)}\nSaved to {args.out}')
+
+    if args.compare is not None and compare(results, args.compare, args.tolerance):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
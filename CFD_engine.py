@@ -0,0 +1,1243 @@
+#CFD engine
+#Shared functions used by both the CFD plotter script and the CFD app
+#Finds every site of a chromosome at once (sorted positions + searchsorted) and gathers the
+#+/- window of reads for all the sites into a single (n_sites x 2*window+1) numpy matrix
+#rather than looping over each gene and building a pandas Series at a time
+
+
+#import modules
+import gzip
+import hashlib
+import io
+import json
+import mmap
+import os
+import pickle
+import shutil
+import struct
+import tempfile
+import threading
+import time
+import tracemalloc
+import warnings
+import zlib
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from contextlib import contextmanager, nullcontext
+from multiprocessing import get_context, shared_memory
+
+import numpy as np
+import pandas as pd
+
+#pyarrow is only needed for the parquet and feather output formats (and the faster multi-threaded parser)
+try:
+    import pyarrow as pa
+    import pyarrow.csv
+    import pyarrow.ipc
+    import pyarrow.parquet
+except ImportError:
+    pa = None
+
+#Window either side of the site (in bins) and the size of each bin in bp (+/-120 bins of 10bp = +/-1200bp)
+WINDOW = 120
+BIN_SIZE = 10
+
+#Compact column types for the input files (categorical chromosomes, int32 positions and float32 reads)
+#These are also the schema read_table parses the files with (the leading columns in order, any others are skipped)
+#Site files can have a 5th group column (e.g. expression quartile or gene class) to make a CFD for each group of sites
+SGR_DTYPES = {'chr': 'category', 'site': np.int32, 'reads': np.float32}
+SITE_DTYPES = {'chr': 'category', 'gene': str, 'site': np.float64, 'strand': 'category', 'group': str}
+SITE_OPTIONAL = ('group',)
+
+#Extension of the region index kept next to a sorted plain text sgr file (see SgrRegionIndex)
+SGR_INDEX_EXTENSION = '.cfdi'
+
+#Rounding methods for matching the site positions to the sgr bins
+#half_up is the original method (5 and above rounded up, below 5 rounded down) and is not affected by floats
+ROUNDING = {
+    'half_up': lambda sites, bin_size: np.floor((sites + bin_size / 2) / bin_size) * bin_size,
+    'nearest': lambda sites, bin_size: np.round(sites / bin_size) * bin_size,
+    'floor': lambda sites, bin_size: np.floor(sites / bin_size) * bin_size,
+    'ceil': lambda sites, bin_size: np.ceil(sites / bin_size) * bin_size,
+}
+
+
+#Rows in each record batch (row group) of parquet and feather tables
+ARROW_BATCH_ROWS = 65536
+
+#Output formats for the tables and the file extension added for each (tsv keeps the original file names)
+OUTPUT_FORMATS = {
+    'tsv': '',
+    'tsv.gz': '.gz',
+    'parquet': '.parquet',
+    'feather': '.feather',
+    'npz': '.npz',
+}
+
+
+#Raised (e.g. from a progress callback) to stop a run that has been cancelled
+class CFDCancelled(Exception):
+    pass
+
+
+#Reads a bgzip file (blocks of up to 64KB that are each a separate gzip member, as made by bgzip/htslib)
+#The blocks don't depend on each other so a batch of blocks is decompressed across threads (zlib releases the GIL)
+#while the previous batch is being parsed, nothing is written to disk
+class BgzfReader(io.RawIOBase):
+
+    def __init__(self, handle, threads=None, batch_blocks=64):
+        self.handle = handle
+        self.batch_blocks = batch_blocks
+        self.pool = ThreadPoolExecutor(max_workers=threads or os.cpu_count())
+        self.data = memoryview(b'')
+        self.pending = self._submit_batch()
+
+    def readable(self):
+        return True
+
+    #Reads the next block from the file, returns (compressed data, crc, size) or None at the end of the file
+    def _read_block(self):
+        header = self.handle.read(12)
+        if len(header) < 12:
+            return None
+        if header[:4] != b'\x1f\x8b\x08\x04':
+            raise ValueError('The file is not a bgzip file (a block is missing its BC header)')
+        extra_length = struct.unpack('<H', header[10:12])[0]
+        extra = self.handle.read(extra_length)
+
+        block_size = None
+        position = 0
+        while position + 4 <= len(extra):
+            field_length = struct.unpack('<H', extra[position + 2:position + 4])[0]
+            if extra[position:position + 2] == b'BC':
+                block_size = struct.unpack('<H', extra[position + 4:position + 6])[0] + 1
+            position += 4 + field_length
+        if block_size is None:
+            raise ValueError('The file is not a bgzip file (a block is missing its BC header)')
+
+        compressed = self.handle.read(block_size - extra_length - 20)
+        crc, size = struct.unpack('<II', self.handle.read(8))
+        return compressed, crc, size
+
+    @staticmethod
+    def _inflate(block):
+        compressed, crc, size = block
+        data = zlib.decompress(compressed, -15)
+        if len(data) != size or zlib.crc32(data) != crc:
+            raise ValueError('A bgzip block is corrupt (the size or checksum does not match)')
+        return data
+
+    #Starts decompressing the next batch of blocks
+    def _submit_batch(self):
+        futures = []
+        for _ in range(self.batch_blocks):
+            block = self._read_block()
+            if block is None:
+                break
+            futures.append(self.pool.submit(self._inflate, block))
+        return futures
+
+    def readinto(self, buffer):
+        while not self.data:
+            if not self.pending:
+                return 0
+            batch = b''.join(future.result() for future in self.pending)
+            self.pending = self._submit_batch()
+            self.data = memoryview(batch)
+
+        n = min(len(buffer), len(self.data))
+        buffer[:n] = self.data[:n]
+        self.data = self.data[n:]
+        return n
+
+    def close(self):
+        if not self.closed:
+            self.pool.shutdown(wait=False, cancel_futures=True)
+            self.handle.close()
+        super().close()
+
+
+#Opens an sgr or site file as a binary stream for read_csv, plain text or compressed with gzip or bgzip
+#(told apart from the first bytes rather than the name so .gz files made by bgzip also use the threaded reader)
+#source is a path or a binary file object (e.g. io.BytesIO of an upload), threads is used for bgzip files
+def open_input(source, threads=None):
+    handle = open(source, 'rb') if isinstance(source, (str, os.PathLike)) else source
+    start = handle.read(18)
+    handle.seek(-len(start), io.SEEK_CUR)
+
+    if start[:2] != b'\x1f\x8b':
+        return handle
+    if len(start) >= 14 and start[3] & 4 and start[12:14] == b'BC':
+        return io.BufferedReader(BgzfReader(handle, threads), 1024**2)
+    if handle is source:
+        return gzip.GzipFile(fileobj=handle)
+    handle.close()
+    return gzip.open(source)
+
+
+#Decompresses as much of the start of a gzip or bgzip file as possible (for checking the first lines)
+#Plain text is returned unchanged
+def decompress_head(head):
+    text = []
+    while head[:2] == b'\x1f\x8b':
+        decompressor = zlib.decompressobj(31)
+        try:
+            text.append(decompressor.decompress(head))
+        except zlib.error:
+            break
+        if not decompressor.eof:
+            break
+        head = decompressor.unused_data
+    return b''.join(text) if text else head
+
+
+#Distances from the site used as the index of the output (-1200 ... 1200)
+def distances(window=WINDOW, bin_size=BIN_SIZE):
+    return range(-window * bin_size, window * bin_size + bin_size, bin_size)
+
+
+#pyarrow type of each of the column types used in SGR_DTYPES and SITE_DTYPES
+def arrow_type(dtype):
+    if dtype == 'category':
+        return pa.dictionary(pa.int32(), pa.string())
+    if dtype is str:
+        return pa.string()
+    return pa.from_numpy_dtype(dtype)
+
+
+#Parses a tab separated file with no header using a fixed schema (column name -> type of the leading columns, others are skipped)
+#so there is no type guessing. pyarrow's multi-threaded csv reader is used if it is installed, otherwise the pandas C parser
+#(engine 'pyarrow' or 'pandas' picks one). source is a binary file object (e.g. from open_input) or bytes, which are parsed
+#straight from the buffer rather than decoded to a string first
+#Columns in optional can be missing from the file (they are left out of the DataFrame), any other missing column is an error
+#pyarrow can't read files where only some rows have the optional columns so these are parsed again with pandas
+#(which leaves them empty), the file is read into memory first so it can be parsed twice
+#parse_threads of 1 parses with pyarrow on a single thread (None uses its thread pool)
+#The number of rows and the time taken are kept in df.attrs['parse'] (see parse_rate)
+def read_table(source, schema, engine=None, parse_threads=None, block_bytes=16 * 1024**2, optional=()):
+    engine = engine or ('pyarrow' if pa is not None else 'pandas')
+    if engine not in ('pyarrow', 'pandas'):
+        raise ValueError(f'Unknown parser {engine} (use pyarrow or pandas)')
+    start = time.perf_counter()
+
+    if engine == 'pyarrow':
+        if pa is None:
+            raise ImportError('pyarrow is needed for the pyarrow parser')
+        if isinstance(source, io.BytesIO):
+            source = source.getbuffer()
+        elif optional and not isinstance(source, (bytes, bytearray, memoryview)):
+            source = source.read()
+        names = [f'f{number}' for number in range(len(schema))]
+        try:
+            table = pyarrow.csv.read_csv(
+                pa.BufferReader(source) if isinstance(source, (bytes, bytearray, memoryview)) else source,
+                read_options=pyarrow.csv.ReadOptions(autogenerate_column_names=True, use_threads=parse_threads != 1, block_size=block_bytes),
+                parse_options=pyarrow.csv.ParseOptions(delimiter='\t'),
+                convert_options=pyarrow.csv.ConvertOptions(include_columns=names, include_missing_columns=True, column_types={name: arrow_type(dtype) for name, dtype in zip(names, schema.values())}),
+            )
+            df = table.rename_columns(list(schema)).to_pandas()
+        except pa.ArrowInvalid:
+            if not optional:
+                raise
+            engine = 'pandas'
+
+    if engine == 'pandas':
+        if isinstance(source, (bytes, bytearray, memoryview)):
+            source = io.BytesIO(source)
+        #Columns past the schema are dropped (pandas warns about them)
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore', pd.errors.ParserWarning)
+            df = pd.read_csv(source, delimiter='\t', header=None, names=list(schema), index_col=False, dtype=schema)
+
+    #Columns missing from the file are read as empty
+    for column in schema:
+        if len(df) and df[column].isna().all():
+            if column not in optional:
+                raise ValueError(f'The file has no {column} column (the columns are {", ".join(name for name in schema if name not in optional)})')
+            df = df.drop(columns=column)
+
+    seconds = time.perf_counter() - start
+    df.attrs['parse'] = {'engine': engine, 'rows': len(df), 'seconds': seconds}
+    return df
+
+
+#Rows parsed by read_table and how fast, as text for printing
+def parse_rate(df):
+    parse = df.attrs.get('parse')
+    if parse is None:
+        return ''
+    return f"Parsed {parse['rows']} rows in {parse['seconds']:.2f} s ({parse['rows'] / max(parse['seconds'], 1e-9):,.0f} rows/s with {parse['engine']})"
+
+
+#Open a site file (chr, gene, site, strand and optionally group with no header), plain or gzip/bgzip compressed
+def read_sites(site_file, engine=None):
+    with open_input(site_file) as handle:
+        return read_table(handle, SITE_DTYPES, engine, optional=SITE_OPTIONAL)
+
+
+#Open a whole sgr file (chr, site, reads with no header) with the compact column types, plain or gzip/bgzip compressed
+#threads are the bgzip decompression threads (see open_input) and parse_threads the parsing threads (see read_table)
+def read_sgr(sgr_file, threads=None, engine=None, parse_threads=None):
+    with open_input(sgr_file, threads) as handle:
+        return read_table(handle, SGR_DTYPES, engine, parse_threads)
+
+
+#Memory used by a hash table of chromosome arrays in bytes
+def memory_footprint(chromosomes):
+    return sum(positions.nbytes + reads.nbytes for positions, reads in chromosomes.values())
+
+
+#Site index built once per site file and reused unchanged for every sgr file in a run
+#   -Rounds the sites to the bins (vectorised, selectable rounding method and bin size)
+#   -Groups the sites by chromosome with the identical positions of each chromosome deduplicated
+#   -Pre-splits the forward and reverse strand masks
+class SiteIndex:
+
+    def __init__(self, site_input, bin_size=BIN_SIZE, rounding='half_up'):
+        if rounding not in ROUNDING:
+            raise ValueError(f'Unknown rounding method {rounding}, use one of {", ".join(ROUNDING)}')
+        self.bin_size = bin_size
+        self.rounding = rounding
+
+        #Chromosome names are always kept as strings so numbered chromosomes match the sgr files
+        self.chrs = site_input['chr'].astype(str).to_numpy()
+        self.genes = site_input['gene'].to_numpy()
+        self.sites = ROUNDING[rounding](site_input['site'].to_numpy(dtype=np.float64), bin_size).astype(np.int64)
+        self.strands = site_input['strand'].to_numpy()
+
+        self.forward = self.strands == 'F'
+        self.reverse = self.strands == 'R'
+
+        #Group of each site (None if the site file has no group column), blank groups are missing and left out of the groups
+        self.groups = None
+        if 'group' in site_input:
+            groups = site_input['group'].str.strip()
+            self.groups = groups.mask(groups == '').to_numpy(dtype=object)
+
+        #chromosome -> (rows of the site file, sorted unique positions, position of each row within the unique positions)
+        self.chromosomes = {}
+        codes, names = pd.factorize(self.chrs)
+        order = np.argsort(codes, kind='stable')
+        bounds = np.searchsorted(codes[order], np.arange(len(names) + 1))
+        for code, chrom in enumerate(names):
+            rows = order[bounds[code]:bounds[code + 1]]
+            positions, inverse = np.unique(self.sites[rows], return_inverse=True)
+            self.chromosomes[chrom] = (rows, positions, inverse)
+
+    def __len__(self):
+        return self.sites.size
+
+    #Builds the index from a site file, optionally keeping it in cache_dir keyed by a hash of the file
+    #(and the rounding settings) so it is only processed once
+    @classmethod
+    def from_file(cls, site_file, bin_size=BIN_SIZE, rounding='half_up', cache_dir=None):
+        if cache_dir is None:
+            return cls(read_sites(site_file), bin_size, rounding)
+
+        with open(site_file, 'rb') as handle:
+            digest = hashlib.sha1(handle.read())
+        digest.update(f'{bin_size}:{rounding}:{",".join(SITE_DTYPES)}:blank_groups'.encode())
+        cache_file = os.path.join(cache_dir, f'site_index_{digest.hexdigest()}.pkl')
+
+        if os.path.exists(cache_file):
+            with open(cache_file, 'rb') as handle:
+                return pickle.load(handle)
+
+        site_index = cls(read_sites(site_file), bin_size, rounding)
+        os.makedirs(cache_dir, exist_ok=True)
+        with open(cache_file, 'wb') as handle:
+            pickle.dump(site_index, handle, protocol=pickle.HIGHEST_PROTOCOL)
+        return site_index
+
+
+#Quick check of the first lines of an sgr or site file (without parsing the whole file)
+#head is the start of the file as text, if truncated is True the last (possibly partial) line is ignored
+#Returns the metadata of the lines checked: number of lines and columns, if the number columns hold numbers,
+#the chromosome names and (for site files) the strand alphabet
+def sniff_text(head, site=False, n_lines=1000, truncated=False):
+    lines = head.splitlines()
+    if truncated:
+        lines = lines[:-1]
+    rows = [line.split('\t') for line in lines[:n_lines] if line.strip()]
+
+    column_counts = {len(row) for row in rows}
+    number_columns = [2] if site else [1, 2]
+    numeric = True
+    for row in rows:
+        for column in number_columns:
+            try:
+                float(row[column])
+            except (IndexError, ValueError):
+                numeric = False
+
+    info = {
+        'lines': len(rows),
+        'columns': max(column_counts) if rows else 0,
+        #(site files can have the group column on only some rows)
+        'consistent': len(column_counts) <= 1 or (site and column_counts <= {4, 5}),
+        'numeric': numeric,
+        'chromosomes': sorted({row[0] for row in rows}),
+    }
+    if site:
+        info['strands'] = sorted({row[3].strip() for row in rows if len(row) > 3})
+    return info
+
+
+#Changing the chromosome slices to within a hash table of (positions, reads) arrays
+#The positions are sorted so the sites can be found with searchsorted
+def split_chromosomes(sgr_input):
+    all_positions = sgr_input['site'].to_numpy()
+    all_reads = sgr_input['reads'].to_numpy()
+
+    chrs = sgr_input['chr']
+    if isinstance(chrs.dtype, pd.CategoricalDtype):
+        codes = chrs.cat.codes.to_numpy()
+    else:
+        codes = pd.factorize(chrs)[0]
+    starts = np.flatnonzero(np.diff(codes, prepend=-1))
+    bounds = np.append(starts, codes.size)
+
+    if starts.size == np.unique(codes).size:
+        #sgr files are grouped by chromosome so each one is a contiguous run of rows and its arrays are slices (no copies)
+        pieces = [(chrs.iloc[start], slice(start, end)) for start, end in zip(bounds[:-1], bounds[1:])]
+    else:
+        pieces = sgr_input.groupby('chr', sort=False, observed=True).indices.items()
+
+    chromosomes = {}
+    for chrom, rows in pieces:
+        positions = all_positions[rows]
+        reads = all_reads[rows]
+        if (np.diff(positions) < 0).any():
+            order = np.argsort(positions, kind='stable')
+            positions, reads = positions[order], reads[order]
+        chromosomes[str(chrom)] = (positions, reads)
+
+    return chromosomes
+
+
+#Streaming (bounded memory) sgr reader
+#Reads the sgr in fixed size chunks and only keeps the bins within the window of at least one site
+#so the memory used scales with the number of sites rather than with the size of the genome
+#Returns the same hash table of (positions, reads) arrays as split_chromosomes and the number of bins/chromosomes read
+def read_sgr_near_sites(sgr_file, site_index, window=WINDOW, chunksize=1000000, threads=None):
+    span = window * site_index.bin_size
+    kept = {}
+    bins_read = 0
+    chromosomes_read = set()
+
+    #Compressed files are decompressed as they are read (see open_input)
+    with open_input(sgr_file, threads) as handle:
+        chunks = pd.read_csv(handle, delimiter='\t', header=None, names=['chr', 'site', 'reads'], chunksize=chunksize,
+                             dtype={'chr': str, 'site': np.int32, 'reads': np.float32})
+        for chunk in chunks:
+            bins_read += len(chunk)
+            all_positions = chunk['site'].to_numpy()
+            all_reads = chunk['reads'].to_numpy()
+
+            for chrom, rows in chunk.groupby('chr', sort=False).indices.items():
+                chromosomes_read.add(chrom)
+                if chrom not in site_index.chromosomes:
+                    continue
+                site_positions = site_index.chromosomes[chrom][1]
+
+                #A bin is near a site if the first site at or after (bin - span) is no further than (bin + span)
+                positions = all_positions[rows]
+                nearest = np.searchsorted(site_positions, positions - span)
+                near = nearest < site_positions.size
+                near[near] = site_positions[nearest[near]] <= positions[near] + span
+
+                kept.setdefault(chrom, []).append((positions[near], all_reads[rows][near]))
+
+    chromosomes = {}
+    for chrom, parts in kept.items():
+        positions = np.concatenate([part[0] for part in parts])
+        reads = np.concatenate([part[1] for part in parts])
+        if (np.diff(positions) < 0).any():
+            order = np.argsort(positions, kind='stable')
+            positions, reads = positions[order], reads[order]
+        chromosomes[chrom] = (positions, reads)
+
+    return chromosomes, bins_read, len(chromosomes_read)
+
+
+#Chromosome and position of the line starting at offset of a memory-mapped sgr file (None for a blank line)
+def line_at(data, offset):
+    end = data.find(b'\n', offset)
+    fields = data[offset:end if end != -1 else len(data)].split()
+    if not fields:
+        return None
+    return fields[0].decode(), int(fields[1])
+
+
+#Length and a hash of the chromosome name (the text before the first tab or space) of the lines starting at starts
+#of a memory-mapped sgr file (whole as a numpy view), one byte of every line at a time so no line is parsed
+#Used to find every line where the chromosome changes (blank lines have a length of 0)
+def chromosome_keys(whole, starts):
+    lengths = np.zeros(starts.size, dtype=np.int64)
+    hashes = np.zeros(starts.size, dtype=np.uint64)
+    active = np.arange(starts.size)
+    while active.size:
+        where = starts[active] + lengths[active]
+        active, where = active[where < whole.size], where[where < whole.size]
+        values = whole[where]
+        named = (values != 9) & (values != 10) & (values != 13) & (values != 32)
+        active = active[named]
+        hashes[active] = (hashes[active] ^ values[named].astype(np.uint64)) * np.uint64(1099511628211)
+        lengths[active] += 1
+    return lengths, hashes
+
+
+#Sidecar region index of a sorted plain text sgr file (similar to a tabix index), saved next to it as {sgr}.cfdi
+#Keeps the byte offset and position of every `every`th line and of the first line of each chromosome so only the
+#parts of the file near the sites need to be read (see read_sgr_regions)
+#The sgr has to be sorted (each chromosome in one block with its positions ascending), every line is checked for the
+#chromosome blocks and the positions are checked on the lines sampled
+#chromosomes maps each chromosome to (positions, byte offsets, byte offset of the end of the chromosome)
+class SgrRegionIndex:
+
+    def __init__(self, chromosomes, every, size, mtime_ns):
+        self.chromosomes = chromosomes
+        self.every = every
+        self.size = size
+        self.mtime_ns = mtime_ns
+
+    @staticmethod
+    def path_for(sgr_file):
+        return sgr_file + SGR_INDEX_EXTENSION
+
+    #Scans the file a block at a time for the line starts and the lines where the chromosome changes (numpy on the
+    #memory-mapped file) and only parses the sampled lines and the first line of each chromosome block
+    @classmethod
+    def build(cls, sgr_file, every=1000, block_bytes=64 * 1024**2):
+        stat = os.stat(sgr_file)
+        entries = []
+        with open(sgr_file, 'rb') as handle:
+            if handle.read(2) == b'\x1f\x8b':
+                raise ValueError(f'{sgr_file} is compressed, only plain text sgr files can be indexed')
+            if stat.st_size > 0:
+                with mmap.mmap(handle.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                    size = len(data)
+                    whole = np.frombuffer(data, np.uint8)
+                    #Start of every `every`th line, the first line, the last line and the first line of each chromosome block
+                    offsets = [0, data.rfind(b'\n', 0, size - 1) + 1]
+                    lines = 0
+                    previous = chromosome_keys(whole, np.zeros(1, dtype=np.int64))
+                    for start in range(0, size, block_bytes):
+                        starts = np.flatnonzero(whole[start:start + block_bytes] == 10) + start + 1
+                        starts = starts[starts < size]
+                        offsets.extend(starts[(np.arange(lines + 1, lines + 1 + starts.size) % every) == 0].tolist())
+                        lines += starts.size
+
+                        lengths, hashes = chromosome_keys(whole, starts)
+                        named = lengths > 0
+                        starts, lengths, hashes = starts[named], np.concatenate([previous[0], lengths[named]]), np.concatenate([previous[1], hashes[named]])
+                        changed = (lengths[1:] != lengths[:-1]) | (hashes[1:] != hashes[:-1])
+                        offsets.extend(starts[changed].tolist())
+                        previous = lengths[-1:], hashes[-1:]
+                    del whole
+
+                    entries = [(offset, *line) for offset in sorted(set(offsets)) for line in [line_at(data, offset)] if line is not None]
+
+        #Grouped into the block of each chromosome
+        chromosomes = {}
+        bounds = [number for number in range(len(entries)) if number == 0 or entries[number][1] != entries[number - 1][1]] + [len(entries)]
+        for first, last in zip(bounds[:-1], bounds[1:]):
+            chrom = entries[first][1]
+            positions = np.array([entry[2] for entry in entries[first:last]], dtype=np.int64)
+            if chrom in chromosomes or (np.diff(positions) < 0).any():
+                raise ValueError(f'{sgr_file} needs to be sorted by chromosome and position to be indexed ({chrom} is out of order)')
+            end = entries[last][0] if last < len(entries) else stat.st_size
+            chromosomes[chrom] = (positions, np.array([entry[0] for entry in entries[first:last]], dtype=np.int64), end)
+
+        return cls(chromosomes, every, stat.st_size, stat.st_mtime_ns)
+
+    def save(self, index_file):
+        names = list(self.chromosomes)
+        empty = [np.zeros(0, dtype=np.int64)]
+        with open(index_file, 'wb') as handle:
+            np.savez(
+                handle,
+                names=np.array(names, dtype=str),
+                lengths=np.array([self.chromosomes[chrom][0].size for chrom in names], dtype=np.int64),
+                positions=np.concatenate([self.chromosomes[chrom][0] for chrom in names] + empty),
+                offsets=np.concatenate([self.chromosomes[chrom][1] for chrom in names] + empty),
+                ends=np.array([self.chromosomes[chrom][2] for chrom in names], dtype=np.int64),
+                info=np.array([self.every, self.size, self.mtime_ns], dtype=np.int64),
+            )
+
+    #Returns the index of sgr_file or None if it has no index or the file has changed since it was indexed
+    @classmethod
+    def load(cls, sgr_file, index_file=None):
+        index_file = index_file or cls.path_for(sgr_file)
+        if not os.path.exists(index_file):
+            return None
+        with np.load(index_file) as saved:
+            every, size, mtime_ns = saved['info'].tolist()
+            stat = os.stat(sgr_file)
+            if (stat.st_size, stat.st_mtime_ns) != (size, mtime_ns):
+                print(f'The region index of {sgr_file} is out of date and needs rebuilding')
+                return None
+            bounds = np.concatenate([[0], np.cumsum(saved['lengths'])])
+            positions, offsets = saved['positions'], saved['offsets']
+            chromosomes = {
+                str(chrom): (positions[first:last], offsets[first:last], int(end))
+                for chrom, first, last, end in zip(saved['names'], bounds[:-1], bounds[1:], saved['ends'])
+            }
+        return cls(chromosomes, every, size, mtime_ns)
+
+    #Sorted (start, end) byte ranges of the file holding every bin within span bp of a site, overlapping ranges joined
+    def byte_ranges(self, site_index, span):
+        starts = []
+        ends = []
+        for chrom, (rows, site_positions, inverse) in site_index.chromosomes.items():
+            if chrom not in self.chromosomes:
+                continue
+            positions, offsets, end = self.chromosomes[chrom]
+            #From the last sampled line before the window to the first sampled line past it
+            first = np.maximum(np.searchsorted(positions, site_positions - span, 'left') - 1, 0)
+            last = np.searchsorted(positions, site_positions + span, 'right')
+            starts.append(offsets[first])
+            ends.append(np.append(offsets, end)[last])
+        if not starts:
+            return []
+
+        starts = np.concatenate(starts)
+        ends = np.concatenate(ends)
+        order = np.argsort(starts, kind='stable')
+        starts, ends = starts[order], np.maximum.accumulate(ends[order])
+        new = np.flatnonzero(np.concatenate([[True], starts[1:] > ends[:-1]]))
+        return list(zip(starts[new].tolist(), np.maximum.reduceat(ends, new).tolist()))
+
+
+#Reads only the parts of a sorted plain text sgr file within window bins of a site, using its SgrRegionIndex
+#(each range is read with a seek and they are all parsed together), so a few sites against a very large file
+#read megabytes rather than the whole file
+#Returns the same hash table of (positions, reads) arrays as read_sgr_near_sites and the number of bins/chromosomes read
+def read_sgr_regions(sgr_file, site_index, window=WINDOW, region_index=None):
+    if region_index is None:
+        region_index = SgrRegionIndex.load(sgr_file)
+        if region_index is None:
+            raise ValueError(f'{sgr_file} has no up to date region index (build one with CFD_index.py)')
+
+    parts = []
+    with open(sgr_file, 'rb') as handle:
+        for start, end in region_index.byte_ranges(site_index, window * site_index.bin_size):
+            handle.seek(start)
+            parts.append(handle.read(end - start))
+    if not parts:
+        return {}, 0, 0
+
+    sgr_input = read_table(b''.join(parts), SGR_DTYPES)
+    chromosomes = split_chromosomes(sgr_input)
+    return chromosomes, len(sgr_input), len(chromosomes)
+
+
+#On disk cache of parsed sgr files
+#Each sgr is kept as per chromosome binary arrays (positions, reads) which are memory-mapped when loaded
+#so repeat runs of the same files skip parsing the text entirely
+#Entries are keyed by file path + size + modified time (or a hash of the contents for uploads)
+#and the least recently used entries are removed when the cache is bigger than max_bytes
+class SgrCache:
+
+    def __init__(self, cache_dir, max_bytes=2 * 1024**3):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        os.makedirs(cache_dir, exist_ok=True)
+
+    @staticmethod
+    def key_for_file(sgr_file):
+        stat = os.stat(sgr_file)
+        return hashlib.sha1(f'{os.path.abspath(sgr_file)}:{stat.st_size}:{stat.st_mtime_ns}'.encode()).hexdigest()
+
+    @staticmethod
+    def key_for_bytes(contents):
+        if isinstance(contents, str):
+            contents = contents.encode()
+        return hashlib.sha1(contents).hexdigest()
+
+    #Returns the memory-mapped chromosomes for key or None if it isn't cached
+    def get(self, key):
+        entry = os.path.join(self.cache_dir, key)
+        try:
+            with open(os.path.join(entry, 'chromosomes.json')) as handle:
+                names = json.load(handle)
+        except (OSError, ValueError):
+            return None
+
+        chromosomes = {}
+        for number, chrom in enumerate(names):
+            positions = np.load(os.path.join(entry, f'{number}_positions.npy'), mmap_mode='r')
+            reads = np.load(os.path.join(entry, f'{number}_reads.npy'), mmap_mode='r')
+            chromosomes[str(chrom)] = (positions, reads)
+
+        #Mark as recently used
+        os.utime(entry)
+        return chromosomes
+
+    #Files bigger than the whole cache aren't cached (they would only be written and then removed with everything else)
+    def put(self, key, chromosomes):
+        entry = os.path.join(self.cache_dir, key)
+        if os.path.exists(entry) or memory_footprint(chromosomes) > self.max_bytes:
+            return
+
+        #Written to a temporary folder first so a half written entry is never read
+        temp_entry = tempfile.mkdtemp(dir=self.cache_dir, prefix='.tmp_')
+        for number, (positions, reads) in enumerate(chromosomes.values()):
+            np.save(os.path.join(temp_entry, f'{number}_positions.npy'), np.asarray(positions))
+            np.save(os.path.join(temp_entry, f'{number}_reads.npy'), np.asarray(reads))
+        with open(os.path.join(temp_entry, 'chromosomes.json'), 'w') as handle:
+            json.dump([str(chrom) for chrom in chromosomes], handle)
+
+        try:
+            os.rename(temp_entry, entry)
+        except OSError:
+            #Another process cached the same file first
+            shutil.rmtree(temp_entry, ignore_errors=True)
+
+        self.evict()
+
+    #Remove the least recently used entries until the cache fits in max_bytes
+    def evict(self):
+        entries = []
+        for key in os.listdir(self.cache_dir):
+            entry = os.path.join(self.cache_dir, key)
+            if key.startswith('.') or not os.path.isdir(entry):
+                continue
+            size = sum(file.stat().st_size for file in os.scandir(entry))
+            entries.append((os.stat(entry).st_mtime, size, entry))
+
+        total = sum(size for _, size, _ in entries)
+        for _, size, entry in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            shutil.rmtree(entry, ignore_errors=True)
+            total -= size
+
+    #Returns the chromosomes of an sgr file, parsing it (with read_sgr) and caching it if it isn't already cached
+    #sgr_file can also be a buffer of an uploaded file when key is given (e.g. from key_for_bytes)
+    def load(self, sgr_file, key=None, threads=None):
+        if key is None:
+            key = self.key_for_file(sgr_file)
+        chromosomes = self.get(key)
+        if chromosomes is None:
+            sgr_input = read_sgr(sgr_file, threads=threads)
+            print(f'{os.path.basename(str(sgr_file))}: {parse_rate(sgr_input)}')
+            chromosomes = split_chromosomes(sgr_input)
+            del sgr_input
+            self.put(key, chromosomes)
+            chromosomes = self.get(key) or chromosomes
+        return chromosomes
+
+
+#Rough size in bytes of a cached object (arrays, DataFrames and containers of them)
+def sizeof(item):
+    if isinstance(item, np.ndarray):
+        return item.nbytes
+    if isinstance(item, pd.DataFrame):
+        return int(item.memory_usage(deep=True).sum())
+    if isinstance(item, pd.Series):
+        return int(item.memory_usage(deep=True))
+    if isinstance(item, dict):
+        return sum(sizeof(key) + sizeof(value) for key, value in item.items())
+    if isinstance(item, (list, tuple)):
+        return sum(sizeof(value) for value in item)
+    if isinstance(item, (str, bytes)):
+        return len(item)
+    if hasattr(item, '__dict__'):
+        return sizeof(vars(item))
+    return 64
+
+
+#In memory least recently used store with a memory budget (thread safe as the Dash server runs callbacks in threads)
+#Items bigger than the whole budget are not kept
+class MemoryLRU:
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.items = OrderedDict()
+        self.total = 0
+        self.lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self.lock:
+            if key not in self.items:
+                return default
+            self.items.move_to_end(key)
+            return self.items[key][0]
+
+    def put(self, key, item):
+        size = sizeof(item)
+        with self.lock:
+            if key in self.items:
+                self.total -= self.items.pop(key)[1]
+            if size > self.max_bytes:
+                return
+            self.items[key] = (item, size)
+            self.total += size
+            while self.total > self.max_bytes:
+                self.total -= self.items.popitem(last=False)[1][1]
+
+
+#Gather the window of reads around every site into one matrix (rows are sites in site file order, columns are bins)
+#Bins missing from the sgr file (e.g. past the end of the chromosome) are left as NaN
+#Reverse strand rows are flipped so every row runs from -window to +window relative to the strand
+#Returns the matrix and a boolean array of which sites were found in the sgr file
+#progress (optional) is called with the number of sites done and the total after each chromosome
+def extract_windows(chromosomes, site_index, window=WINDOW, progress=None):
+    matrix = np.full((len(site_index), 2 * window + 1), np.nan)
+    found = np.zeros(len(site_index), dtype=bool)
+    done = 0
+
+    for chrom, (rows, site_positions, inverse) in site_index.chromosomes.items():
+        done += rows.size
+        if progress is not None:
+            progress(done, len(site_index))
+        if chrom not in chromosomes:
+            continue
+        positions, reads = chromosomes[chrom]
+        if positions.size == 0:
+            continue
+        matrix[rows], found[rows] = gather_windows(positions, reads, site_positions, inverse, site_index.reverse[rows], window, site_index.bin_size)
+
+    return matrix, found
+
+
+#Window rows of the sites of one chromosome gathered from its sgr bins (site_positions and inverse as in SiteIndex.chromosomes
+#and reverse marks the reverse strand rows), returns the window matrix of the rows and which of them were found
+def gather_windows(positions, reads, site_positions, inverse, reverse, window, bin_size):
+    #Every bin position wanted for every unique site of this chromosome, located in one searchsorted call
+    targets = site_positions[:, None] + np.arange(-window, window + 1) * bin_size
+    index = np.minimum(np.searchsorted(positions, targets), positions.size - 1)
+    hits = positions[index] == targets
+
+    #Duplicated sites share the same window
+    block = np.where(hits, reads[index], np.nan)[inverse]
+
+    #Reverse strand reads run the other way so flip those rows
+    block[reverse] = block[reverse, ::-1]
+
+    return block, hits[inverse, window]
+
+
+#Per chromosome cumulative sum (prefix sum) index built once per sgr file
+#The reads between any two positions are the difference of two cumulative sums so any window width
+#and any coarser bin size can be made without rescanning the data
+#Evenly spaced bins are addressed directly (O(1) per output bin), otherwise the positions are found with searchsorted
+class PrefixIndex:
+
+    def __init__(self, chromosomes):
+        self.chromosomes = {}
+        for chrom, (positions, reads) in chromosomes.items():
+            positions = np.asarray(positions)
+            cumulative = np.concatenate([[0.0], np.cumsum(np.nan_to_num(reads), dtype=np.float64)])
+            step = int(positions[1] - positions[0]) if positions.size > 1 else 0
+            regular = step > 0 and bool((np.diff(positions) == step).all())
+            self.chromosomes[chrom] = (positions, cumulative, regular, step)
+
+    #Number of bins of the chromosome before each position in x
+    def _rank(self, chrom, x):
+        positions, cumulative, regular, step = self.chromosomes[chrom]
+        if regular:
+            return np.clip(-((positions[0] - x) // step), 0, positions.size)
+        return np.searchsorted(positions, x)
+
+    #Sum of the reads of the chromosome with lo <= position < hi
+    def range_sums(self, chrom, lo, hi):
+        cumulative = self.chromosomes[chrom][1]
+        return cumulative[self._rank(chrom, hi)] - cumulative[self._rank(chrom, lo)]
+
+    #Window matrix of window bins of out_bin bp either side of every site (same layout as extract_windows)
+    #Each output bin is centred on its distance from the site and reverse strand bins are mirrored around the site
+    def windows(self, site_index, window, out_bin, progress=None):
+        matrix = np.full((len(site_index), 2 * window + 1), np.nan)
+        found = np.zeros(len(site_index), dtype=bool)
+        done = 0
+
+        for chrom, (rows, site_positions, inverse) in site_index.chromosomes.items():
+            done += rows.size
+            if progress is not None:
+                progress(done, len(site_index))
+            if chrom not in self.chromosomes or self.chromosomes[chrom][0].size == 0:
+                continue
+            matrix[rows], found[rows] = self.chromosome_windows(chrom, site_positions[inverse], site_index.reverse[rows], window, out_bin)
+
+        return matrix, found
+
+    #Window rows of the sites (positions) of one chromosome, reverse marks the reverse strand sites
+    #Returns the window matrix of the sites and which of them were found
+    def chromosome_windows(self, chrom, sites, reverse, window, out_bin):
+        starts = np.arange(-window, window + 1) * out_bin - out_bin // 2
+        lo = sites[:, None] + starts
+        lo[reverse] = sites[reverse, None] - starts - out_bin + 1
+
+        #The site itself has to be one of the sgr bins (as in extract_windows)
+        return self.range_sums(chrom, lo, lo + out_bin), self._rank(chrom, sites + 1) - self._rank(chrom, sites) == 1
+
+
+#Chromosomes of an sgr file copied into one block of shared memory so worker processes can use the position and read
+#arrays without them being pickled, layout has the length, offsets and types of the two arrays of each chromosome
+class SharedChromosomes:
+
+    def __init__(self, chromosomes):
+        self.layout = {}
+        size = 0
+        for chrom, (positions, reads) in chromosomes.items():
+            #Each array starts on an 8 byte boundary
+            positions_offset = size
+            reads_offset = positions_offset + -(-positions.nbytes // 8) * 8
+            size = reads_offset + -(-reads.nbytes // 8) * 8
+            self.layout[chrom] = (positions.size, positions_offset, positions.dtype.str, reads_offset, reads.dtype.str)
+
+        self.memory = shared_memory.SharedMemory(create=True, size=max(size, 1))
+        for chrom, (positions, reads) in chromosomes.items():
+            shared_positions, shared_reads = self.arrays(self.memory, self.layout[chrom])
+            shared_positions[:] = positions
+            shared_reads[:] = reads
+            del shared_positions, shared_reads
+
+    #Position and read arrays of one chromosome in the shared memory (no copy)
+    @staticmethod
+    def arrays(memory, chrom_layout):
+        size, positions_offset, positions_type, reads_offset, reads_type = chrom_layout
+        return np.ndarray(size, positions_type, memory.buf, positions_offset), np.ndarray(size, reads_type, memory.buf, reads_offset)
+
+    #Opens the shared memory called name in another process, returns it and the chromosomes dict of its arrays
+    @classmethod
+    def attach(cls, name, layout):
+        memory = shared_memory.SharedMemory(name=name)
+        return memory, {chrom: cls.arrays(memory, chrom_layout) for chrom, chrom_layout in layout.items()}
+
+    def close(self):
+        self.memory.close()
+        self.memory.unlink()
+
+
+#Process pool that splits the site lookup of one sgr file by chromosome so a single large file can use every core
+#The chromosomes are put in shared memory once and each worker attaches to them when it starts, a task is then just
+#a chromosome and its sites, and the window rows of each chromosome are merged into the full matrix as they finish
+#The workers are started with spawn rather than fork as the pool is made from threads (e.g. the app's job pool)
+#and forking a process with other threads running can leave the workers deadlocked
+#Used as
+#    with ChromosomePool(chromosomes, workers) as chromosome_pool:
+#        cfd_for_window(chromosomes, site_index, name, window_bp, window_bin, chromosome_pool=chromosome_pool)
+class ChromosomePool:
+
+    def __init__(self, chromosomes, workers=None):
+        self.shared = SharedChromosomes(chromosomes)
+        self.pool = ProcessPoolExecutor(max_workers=workers, mp_context=get_context('spawn'), initializer=attach_chromosomes, initargs=(self.shared.memory.name, self.shared.layout))
+
+    #Same as extract_windows (window_bin the same as the sgr bins) or PrefixIndex.windows (any other bin size)
+    def windows(self, site_index, window, window_bin, progress=None):
+        matrix = np.full((len(site_index), 2 * window + 1), np.nan)
+        found = np.zeros(len(site_index), dtype=bool)
+        done = 0
+
+        #Chromosomes with the most sites are sent first so the workers finish at about the same time
+        tasks = {}
+        for chrom, (rows, site_positions, inverse) in sorted(site_index.chromosomes.items(), key=lambda item: -item[1][0].size):
+            if chrom not in self.shared.layout or self.shared.layout[chrom][0] == 0:
+                done += rows.size
+                continue
+            future = self.pool.submit(chromosome_windows_in_worker, chrom, site_positions, inverse, site_index.reverse[rows], window, window_bin, site_index.bin_size)
+            tasks[future] = rows
+
+        #The tasks still waiting are dropped if progress raises (e.g. CFDCancelled)
+        try:
+            for future in as_completed(tasks):
+                rows = tasks[future]
+                matrix[rows], found[rows] = future.result()
+                done += rows.size
+                if progress is not None:
+                    progress(done, len(site_index))
+        finally:
+            for future in tasks:
+                future.cancel()
+
+        return matrix, found
+
+    def close(self):
+        self.pool.shutdown(cancel_futures=True)
+        self.shared.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+#Runs once in each ChromosomePool worker, the shared chromosomes (and the prefix index of each chromosome once it is needed)
+#are kept for every task of the worker
+def attach_chromosomes(name, layout):
+    global worker_memory, worker_chromosomes, worker_prefix
+    worker_memory, worker_chromosomes = SharedChromosomes.attach(name, layout)
+    worker_prefix = {}
+
+
+#Window rows of the sites of one chromosome in a ChromosomePool worker
+def chromosome_windows_in_worker(chrom, site_positions, inverse, reverse, window, window_bin, bin_size):
+    positions, reads = worker_chromosomes[chrom]
+    if window_bin == bin_size:
+        return gather_windows(positions, reads, site_positions, inverse, reverse, window, bin_size)
+
+    if chrom not in worker_prefix:
+        worker_prefix[chrom] = PrefixIndex({chrom: (positions, reads)})
+    return worker_prefix[chrom].chromosome_windows(chrom, site_positions[inverse], reverse, window, window_bin)
+
+
+#Runs the CFD for a window of +/- window_bp in bins of window_bin bp
+#Returns the per site DataFrame (final), the normalised sum of each bin, the total reads and the normalisation value
+#Bins the same size as the sgr bins are gathered directly, other bin sizes are summed from the prefix index
+#(pass the same prefix_index to sweep several windows of one sgr file without rebuilding it)
+#With a chromosome_pool (a ChromosomePool of the same chromosomes) the lookup is split by chromosome across its processes
+#progress is passed on to extract_windows (it can raise CFDCancelled to stop a run part way through)
+#stats (a RunStats) records the site lookup and the normalisation as separate phases
+def cfd_for_window(chromosomes, site_index, name, window_bp=WINDOW * BIN_SIZE, window_bin=BIN_SIZE, prefix_index=None, progress=None, stats=None, chromosome_pool=None):
+    if window_bin <= 0 or window_bp % window_bin != 0:
+        raise ValueError(f'The window ({window_bp}bp) needs to be a multiple of the bin size ({window_bin}bp)')
+    #Each bin has to hold a whole number of sgr bins (otherwise the bins alternately get more and fewer sgr bins)
+    if window_bin % site_index.bin_size != 0:
+        raise ValueError(f'The bin size ({window_bin}bp) needs to be a multiple of the sgr bin size ({site_index.bin_size}bp)')
+    window = window_bp // window_bin
+
+    with run_phase(stats, name, 'lookup'):
+        if chromosome_pool is not None:
+            matrix, found = chromosome_pool.windows(site_index, window, window_bin, progress)
+        elif window_bin == site_index.bin_size:
+            matrix, found = extract_windows(chromosomes, site_index, window, progress)
+        else:
+            if prefix_index is None:
+                prefix_index = PrefixIndex(chromosomes)
+            matrix, found = prefix_index.windows(site_index, window, window_bin, progress)
+
+    with run_phase(stats, name, 'normalise'):
+        return cfd_from_matrix(matrix, found, site_index, name, distances(window, window_bin))
+
+
+#Makes the per site DataFrame (final) and the normalised values from the window matrix of the sites
+def cfd_from_matrix(matrix, found, site_index, name, bin_distances):
+    forward = site_index.forward
+    reverse = site_index.reverse
+
+    if (~(forward | reverse)).any():
+        print(f'Encountered {(~(forward | reverse)).sum()} strand directions that are not F or R, these genes will be skipped')
+    missing = (forward | reverse) & ~found
+    if missing.any():
+        print(f'{missing.sum()} sites were not found in {name}, these genes will be skipped')
+
+    #Forward strand genes first then reverse strand genes (same column order as before)
+    #The site file row of each column is kept in final.attrs (used to find the group of each site)
+    order = np.concatenate([np.flatnonzero(forward & found), np.flatnonzero(reverse & found)])
+    final = pd.DataFrame(
+        matrix[order].T,
+        index=bin_distances,
+        columns=site_index.genes[order],
+    )
+    final.attrs['site_rows'] = order
+
+    #Do sum and normalise (normalisation is the total reads divided by the number of bins in the window)
+    bin_sums = np.nansum(matrix[order], axis=0)
+    total_reads = bin_sums.sum()
+    normalisation = total_reads / bin_sums.size
+    after_sum_normalised = pd.Series(bin_sums / normalisation, index=final.index, name=name)
+
+    return final, after_sum_normalised, total_reads, normalisation
+
+
+#Normalised CFD of each group of sites (the group column of the site file) from the per site matrix (final) of cfd_from_matrix
+#The bin sums of every group come from one grouped sum (np.add.reduceat over the sites sorted by group) and each group is
+#normalised by its own total reads / number of bins as in cfd_from_matrix, sites without a group are left out
+#Returns a tidy table with a row for each group and distance (library, group, distance, normalised value and number of sites)
+def cfd_by_group(final, site_index, name):
+    if site_index.groups is None:
+        raise ValueError('The site file has no group column (a 5th column after the strand)')
+
+    codes, names = pd.factorize(site_index.groups[final.attrs['site_rows']], sort=True)
+    values = np.nan_to_num(final.to_numpy(dtype=np.float64).T)[codes >= 0]
+    codes = codes[codes >= 0]
+    order = np.argsort(codes, kind='stable')
+    n_bins = final.shape[0]
+    if codes.size == 0:
+        return pd.DataFrame(columns=['library', 'group', 'distance', 'normalised', 'sites'])
+
+    group_sums = np.add.reduceat(values[order], np.searchsorted(codes[order], np.arange(len(names))), axis=0)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        normalised = group_sums / (group_sums.sum(axis=1, keepdims=True) / n_bins)
+
+    return pd.DataFrame({
+        'library': name,
+        'group': np.repeat(np.asarray(names, dtype=object), n_bins),
+        'distance': np.tile(final.index.to_numpy(), len(names)),
+        'normalised': normalised.ravel(),
+        'sites': np.repeat(np.bincount(codes, minlength=len(names)), n_bins),
+    })
+
+
+#Repeated names get .1, .2 ... added (the same as pandas does when reading the tsv back in)
+def unique_names(names):
+    seen = {}
+    unique = []
+    for name in names:
+        if name in seen:
+            seen[name] += 1
+            name = f'{name}.{seen[name]}'
+        else:
+            seen[name] = 0
+        unique.append(name)
+    return unique
+
+
+#Splits a table into pyarrow record batches of block_rows rows (the index is the first column)
+#Arrow readers can't select duplicate column names so repeated gene names are made unique
+#An empty table gives one empty batch
+def arrow_batches(df, block_rows):
+    names = unique_names([str(df.index.name or '')] + [str(column) for column in df.columns])
+    index = df.index.to_numpy()
+    values = df.to_numpy()
+    for start in range(0, max(len(df), 1), block_rows):
+        block = values[start:start + block_rows]
+        arrays = [pa.array(index[start:start + block_rows])] + [pa.array(block[:, column]) for column in range(block.shape[1])]
+        yield pa.RecordBatch.from_arrays(arrays, names=names)
+
+
+#Writes a table (the per site matrix or the normalised table) to output (a path or a binary file object) as output_format
+#The rows of text tables are written block_rows at a time so the whole table is never turned into a single text buffer
+#(tsv.gz uses gzip level 6, level 9 is several times slower for a few percent smaller files)
+#parquet and feather are written in batches of ARROW_BATCH_ROWS rows, with sites_as_rows the per site matrix is written
+#with a row for each site and a column for each distance (one column per site can't be read back for large site files)
+#(npz is the exception as numpy writes each array in one go, values/index/columns are saved as separate arrays, or for
+#tables with text columns such as the group table, index/columns and one array per column as column0, column1 ...
+#so none of them are pickled objects)
+def write_table(df, output, output_format='tsv', block_rows=64, sites_as_rows=False):
+    if output_format == 'tsv':
+        df.to_csv(output, sep='\t', chunksize=block_rows)
+    elif output_format == 'tsv.gz':
+        df.to_csv(output, sep='\t', chunksize=block_rows, compression={'method': 'gzip', 'compresslevel': 6})
+    elif output_format in ('parquet', 'feather'):
+        if pa is None:
+            raise ImportError(f'pyarrow is needed to write {output_format} files')
+        if sites_as_rows:
+            df = df.T.rename_axis(df.columns.name or 'gene')
+        batches = arrow_batches(df, ARROW_BATCH_ROWS)
+        first = next(batches)
+        if output_format == 'parquet':
+            with pyarrow.parquet.ParquetWriter(output, first.schema) as writer:
+                writer.write_batch(first)
+                for batch in batches:
+                    writer.write_batch(batch)
+        else:
+            with pyarrow.ipc.new_file(output, first.schema) as writer:
+                writer.write_batch(first)
+                for batch in batches:
+                    writer.write_batch(batch)
+    elif output_format == 'npz':
+        index = df.index.to_numpy()
+        index = index.astype(str) if index.dtype == object else index
+        if all(pd.api.types.is_numeric_dtype(dtype) for dtype in df.dtypes):
+            np.savez_compressed(output, values=df.to_numpy(), index=index, columns=df.columns.to_numpy(dtype=str))
+        else:
+            arrays = {f'column{number}': column.to_numpy(dtype=None if pd.api.types.is_numeric_dtype(column) else str) for number, (name, column) in enumerate(df.items())}
+            np.savez_compressed(output, index=index, columns=df.columns.to_numpy(dtype=str), **arrays)
+    else:
+        raise ValueError(f'Unknown output format {output_format} (use one of {", ".join(OUTPUT_FORMATS)})')
+
+
+#Same as write_table but written to a temporary file in the same folder and then renamed over output
+#so anything reading output never sees a half written table
+def replace_table(df, output, output_format='tsv', block_rows=64, sites_as_rows=False):
+    folder, name = os.path.split(os.path.abspath(output))
+    handle, temp_path = tempfile.mkstemp(dir=folder, prefix='.', suffix='_' + name)
+    os.close(handle)
+    try:
+        write_table(df, temp_path, output_format, block_rows, sites_as_rows)
+        os.replace(temp_path, output)
+    except:
+        os.remove(temp_path)
+        raise
+
+
+#Bootstrap confidence interval of the normalised CFD made by resampling the sites (columns of final) with replacement
+#Each replicate is a row of how many times each site was picked so a batch of replicates is a single
+#(batch x sites) @ (sites x bins) matrix product rather than a pandas sum per replicate
+#Every batch has its own seed from seed so the result is the same for any number of workers
+#(the batches are run in threads as numpy releases the GIL for the matrix products)
+#Returns a DataFrame of the lower and upper bound of each bin
+def bootstrap_cfd(final, n_boot=1000, confidence=0.95, seed=0, workers=1, batch_size=50):
+    values = np.nan_to_num(final.to_numpy(dtype=np.float64).T)
+    n_sites, n_bins = values.shape
+    if n_sites == 0 or n_boot <= 0:
+        return pd.DataFrame({'lower': np.nan, 'upper': np.nan}, index=final.index)
+
+    n_batches = -(-n_boot // batch_size)
+    seeds = np.random.SeedSequence(seed).spawn(n_batches)
+
+    def run_batch(number):
+        rng = np.random.default_rng(seeds[number])
+        size = min(batch_size, n_boot - number * batch_size)
+        picks = rng.integers(0, n_sites, (size, n_sites)) + np.arange(size)[:, None] * n_sites
+        counts = np.bincount(picks.ravel(), minlength=size * n_sites).reshape(size, n_sites)
+        bin_sums = counts.astype(np.float64) @ values
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return bin_sums / (bin_sums.sum(axis=1, keepdims=True) / n_bins)
+
+    if workers == 1:
+        replicates = [run_batch(number) for number in range(n_batches)]
+    else:
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            replicates = list(pool.map(run_batch, range(n_batches)))
+
+    tail = (1 - confidence) / 2
+    lower, upper = np.quantile(np.concatenate(replicates), [tail, 1 - tail], axis=0)
+    return pd.DataFrame({'lower': lower, 'upper': upper}, index=final.index)
+
+
+#Opt-in wall time (and peak memory) of each phase of a run for each sgr file, used as
+#    with stats.phase('library.sgr', 'parse'):
+#Memory is the peak traced by tracemalloc during the phase, only if trace_memory is True as tracing slows the run down
+#(tracemalloc covers the whole process so phases running at the same time in other threads are included)
+class RunStats:
+
+    def __init__(self, trace_memory=False):
+        self.trace_memory = trace_memory
+        self.records = []
+        self.lock = threading.Lock()
+        self.started_tracing = trace_memory and not tracemalloc.is_tracing()
+        if self.started_tracing:
+            tracemalloc.start()
+
+    #Stops tracing the memory if this started it (tracing slows everything else down)
+    def stop(self):
+        if self.started_tracing:
+            tracemalloc.stop()
+            self.started_tracing = False
+
+    @contextmanager
+    def phase(self, file, phase):
+        if self.trace_memory:
+            tracemalloc.reset_peak()
+            start_memory = tracemalloc.get_traced_memory()[0]
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            record = {'file': file, 'phase': phase, 'seconds': time.perf_counter() - start, 'peak_mb': None}
+            if self.trace_memory:
+                record['peak_mb'] = (tracemalloc.get_traced_memory()[1] - start_memory) / 1024**2
+            with self.lock:
+                self.records.append(record)
+
+    def to_frame(self):
+        return pd.DataFrame(self.records, columns=['file', 'phase', 'seconds', 'peak_mb'])
+
+    #Saves the records as CSV if path ends in .csv otherwise as JSON
+    def save(self, path):
+        if path.endswith('.csv'):
+            self.to_frame().to_csv(path, index=False)
+        else:
+            with open(path, 'w') as handle:
+                json.dump(self.records, handle, indent=1)
+
+
+#A phase of stats, or nothing if stats is None (so the timing is only done when asked for)
+def run_phase(stats, file, phase):
+    return stats.phase(file, phase) if stats is not None else nullcontext()
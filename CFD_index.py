@@ -0,0 +1,41 @@
+#CFD Index
+#Builds the region index of sorted plain text .sgr files (saved next to each one as {sgr}.cfdi, similar to a tabix index)
+#Used as 'python CFD_index.py sgr_in/library.sgr' from the command line (or a folder to index every .sgr in it)
+#The CFD plotter then only reads the parts of an indexed sgr near the sites when run with --region-index
+#The index is ignored (and needs rebuilding) if the sgr changes after it has been built
+
+#The sgr has to be sorted with each chromosome in one block and its positions ascending
+#(compressed .sgr.gz/.sgr.bgz files can't be indexed as they can't be read from the middle)
+
+
+#import modules
+import argparse
+import os
+import time
+
+from CFD_engine import SgrRegionIndex
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Build the region index of sorted plain text .sgr files')
+    parser.add_argument('sgr', nargs='+', help='.sgr files or folders of .sgr files')
+    parser.add_argument('--every', type=int, default=1000, help='lines between the indexed positions (smaller reads less around each site but makes a bigger index)')
+    args = parser.parse_args()
+
+    sgr_files = []
+    for path in args.sgr:
+        if os.path.isdir(path):
+            sgr_files.extend(os.path.join(path, file) for file in sorted(os.listdir(path)) if file.endswith('.sgr'))
+        else:
+            sgr_files.append(path)
+
+    for sgr_file in sgr_files:
+        start = time.perf_counter()
+        region_index = SgrRegionIndex.build(sgr_file, args.every)
+        index_file = SgrRegionIndex.path_for(sgr_file)
+        region_index.save(index_file)
+        print(f'{sgr_file}: {len(region_index.chromosomes)} chromosomes indexed in {time.perf_counter() - start:.2f} s ({os.path.getsize(index_file) / 1024:.0f} kB)')
+
+
+if __name__ == '__main__':
+    main()
@@ -1,11 +1,13 @@
 #CFD Plotter
 #Takes an .sgr file and a 'site' file to create a +/-1200bp region of the reads for each gene in the site file
 #Also creates a normalised cumulative frequency distribution which can be used to plot a CFD plot in excel 
-#Used as 'python CFD_plotter' from local command line 
+#Used as 'python CFD_plotter_in_progress_current.py' from local command line (see --help for the options)
 #requires:
-    #.sgr file in folder sgr_in
-    #site file in folder site_in
+    #.sgr file in folder sgr_in (can be gzip or bgzip compressed as .sgr.gz or .sgr.bgz)
+    #site file(s) in folder site_in (can also be compressed)
     #out folder
+#Every site file in site_in is used (or the ones given with --sites), each sgr is only read once for all of them
+#and one normalised table is written per site file
 
 #####Optional alterations
 # # -Change the rounding method (This current script is using 5 and above rounded up with below 5 rounded down)
@@ -19,102 +21,447 @@
 
 #import modules 
 import pandas as pd 
+import argparse
 import os 
+import pickle
+import time
 import warnings             #Using this is unnecessary but makes it look cleaner
-import math
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import nullcontext
+from CFD_engine import OUTPUT_FORMATS, ROUNDING, ChromosomePool, PrefixIndex, RunStats, SgrCache, SgrRegionIndex, SiteIndex, bootstrap_cfd, cfd_by_group, cfd_for_window, memory_footprint, parse_rate, read_sgr, read_sgr_near_sites, read_sgr_regions, read_sites, replace_table, run_phase, split_chromosomes, write_table
+#Compressed sgr file extensions (gzip and bgzip)
+SGR_COMPRESSION = ('.gz', '.bgz')
+
 #Remove the futurewarnings for array compaison to str
 warnings.simplefilter(action='ignore',category=FutureWarning)
 
-#Find the files 
-sgr_files = [file for file in os.listdir('sgr_in') if file.endswith('.sgr')]
-site_files = os.listdir('site_in')[0]
-normalised_out=''                           #Idea is to make end normalised file all the files together
-all_normalised_together =pd.DataFrame()
-#open site file rounded to the nearest multiple of 10 (rounding method chosen here)
-site_input = pd.read_csv('site_in\\' +site_files, delimiter ='\t',header=None,names=['chr','gene','site','strand'])   
+#Default settings (each can be changed from the command line, see --help)
+
+#Input and output folders
+sgr_dir = 'sgr_in'
+site_dir = 'site_in'
+out_dir = 'out'
+
+#Site file settings (rounding method is one of half_up, nearest, floor or ceil)
+rounding = 'half_up'                        #Preferable 5 up method as not affected by floats
+bin_size = 10
+site_index_cache = None                     #Set to a folder (e.g. 'out') to keep the processed site file between runs
+
+#Windows to output as (window either side of the site in bp, bin size in bp), the first is the usual +/-1200bp in 10bp bins
+#Extra windows (e.g. (5000, 50)) are summed from a cumulative sum index of each sgr file without reading it again
+windows = [(1200, 10)]
+
+#Streaming mode reads each sgr in chunks and only keeps the bins near sites (for very large genome wide files)
+streaming = False
+chunk_size = 1000000                        #Number of sgr rows read at a time in streaming mode
+
+#Sorted plain text sgr files with a region index (built with CFD_index.py) only have the parts near the sites read
+#(files without an up to date index are read as normal)
+region_index = False
+
+#Parsed sgr files can be cached as binary arrays in this folder so repeat runs of the same files skip the parsing
+#(None turns it off, it keeps a full copy of each sgr file so is only used when asked for, and not with streaming)
+sgr_cache_dir = None
+sgr_cache_size = 2 * 1024**3                #Maximum size of the cache in bytes (least recently used files are removed)
+
+#Format of the output tables, one of tsv (the original text files), tsv.gz, parquet, feather (both need pyarrow) or npz
+#parquet and feather per site tables have a row for each site and a column for each distance
+#Everything other than tsv adds its extension to the file names
+output_format = 'tsv'
+
+#Threads used to decompress bgzip (.sgr.bgz) files (None uses every core), gzip files are read on a single thread
+decompress_threads = None
 
+#Number of sgr files processed at the same time in a process pool (1 runs them one after another, None uses every core)
+workers = 1
 
-site_input.loc[:,'site'] = site_input.loc[:,'site'].apply(lambda x: (x+5)/10).apply(math.floor).apply(lambda x: x*10)   #Preferable 5 up method as not affected by floats
+#Number of processes the chromosomes of each sgr file are split across (1 turns it off, None uses every core)
+#The chromosomes are put in shared memory for the workers, this is for one very large sgr file rather than many small ones
+chromosome_workers = 1
 
-print(f'''The site file {site_files} is being used
-Contains: {(site_input.loc[:,'strand'] == 'F').sum()} Forward strands and {(site_input.loc[:,'strand'] == 'R').sum()} Reverse strands ''')
+#Time (and memory) of each phase for each sgr file, set to a file name (e.g. 'out//run_stats.json' or 'out//run_stats.csv')
+#to save them, None turns it off. Tracing the memory slows the run down so it is a separate setting
+run_stats = None
+run_stats_memory = False
 
+#Bootstrap confidence interval of the normalised values from resampling the sites (0 replicates turns it off)
+#saved as normalised_ci... next to each normalised table with a lower and upper column for each sgr file
+bootstrap = 0
+confidence = 0.95
+seed = 0                                    #Fixed so repeat runs give the same interval
+bootstrap_workers = 1                       #Threads used for the resampling
 
-for file in sgr_files:
+#Normalised CFD of each group of sites (the 5th column of the site files) for every sgr file from the same window matrix
+#saved as normalised_groups... as a tidy table (library, group, distance, normalised value and number of sites)
+groups = False
+
+#Watch mode, checks the folders every watch seconds and only runs the new or changed sgr files (None runs once)
+watch = None
+
+
+#Command line options, the defaults are the settings above
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Makes the per site reads and the normalised CFD of .sgr files around the sites of one or more site files')
+    parser.add_argument('--sgr-dir', default=sgr_dir, help='folder of .sgr (.sgr.gz/.sgr.bgz) files')
+    parser.add_argument('--sgr', nargs='+', help='paths of the sgr files to use (default: every sgr file in --sgr-dir)')
+    parser.add_argument('--site-dir', default=site_dir, help='folder of site files')
+    parser.add_argument('--sites', nargs='+', help='paths of the site files to use (default: every file in --site-dir)')
+    parser.add_argument('--out-dir', default=out_dir, help='output folder')
+    parser.add_argument('--rounding', default=rounding, choices=list(ROUNDING), help='rounding of the sites to the bins')
+    parser.add_argument('--bin-size', type=int, default=bin_size, help='bin size of the sgr files in bp')
+    parser.add_argument('--site-index-cache', default=site_index_cache, help='folder to keep the processed site files in')
+    parser.add_argument('--windows', nargs='+', type=parse_window, default=windows,
+                        help='windows as WINDOW:BIN in bp (e.g. 1200:10 5000:50), the first keeps the original file names')
+    parser.add_argument('--streaming', action='store_true', default=streaming, help='only keep the sgr bins near sites (for very large files)')
+    parser.add_argument('--region-index', action='store_true', default=region_index, help='only read the parts of indexed sgr files near the sites (see CFD_index.py)')
+    parser.add_argument('--chunk-size', type=int, default=chunk_size, help='sgr rows read at a time when streaming')
+    parser.add_argument('--sgr-cache', default=sgr_cache_dir, help='keep parsed sgr files in this folder as a binary cache (off by default)')
+    parser.add_argument('--no-sgr-cache', dest='sgr_cache', action='store_const', const=None, help='turn off the sgr cache')
+    parser.add_argument('--sgr-cache-size', type=int, default=sgr_cache_size, help='maximum size of the sgr cache in bytes')
+    parser.add_argument('--output-format', default=output_format, choices=list(OUTPUT_FORMATS), help='format of the output tables')
+    parser.add_argument('--decompress-threads', type=int, default=decompress_threads, help='threads for bgzip files (default: every core)')
+    parser.add_argument('--workers', type=int, default=workers, help='sgr files processed at the same time (0 uses every core)')
+    parser.add_argument('--chromosome-workers', type=int, default=chromosome_workers, help='processes the chromosomes of each sgr file are split across (0 uses every core)')
+    parser.add_argument('--run-stats', default=run_stats, help='save the time of each phase to this .json or .csv file')
+    parser.add_argument('--run-stats-memory', action='store_true', default=run_stats_memory, help='also trace the memory of each phase (slower)')
+    parser.add_argument('--bootstrap', type=int, default=bootstrap, help='bootstrap replicates for a confidence interval (0 turns it off)')
+    parser.add_argument('--confidence', type=float, default=confidence, help='confidence level of the bootstrap interval')
+    parser.add_argument('--seed', type=int, default=seed, help='random seed of the bootstrap')
+    parser.add_argument('--bootstrap-workers', type=int, default=bootstrap_workers, help='threads used for the bootstrap')
+    parser.add_argument('--groups', action='store_true', default=groups, help='also make a CFD for each group of sites (5th column of the site files)')
+    parser.add_argument('--watch', type=float, default=watch, metavar='SECONDS',
+                        help='keep checking the folders and only run new or changed files (writes normalised..._all tables)')
+    args = parser.parse_args(argv)
+    for window_bp, window_bin in args.windows:
+        if window_bin % args.bin_size != 0:
+            parser.error(f'The bin size of {window_bp}:{window_bin} needs to be a multiple of the sgr bin size ({args.bin_size}bp)')
+    return args
+
+
+#Window given on the command line as WINDOW:BIN in bp
+def parse_window(text):
+    try:
+        window_bp, window_bin = (int(value) for value in text.split(':'))
+    except ValueError:
+        raise argparse.ArgumentTypeError(f'{text} should be WINDOW:BIN in bp, e.g. 1200:10')
+    if window_bin <= 0 or window_bp % window_bin != 0:
+        raise argparse.ArgumentTypeError(f'The window ({window_bp}bp) needs to be a multiple of the bin size ({window_bin}bp)')
+    return (window_bp, window_bin)
+
+
+#Runs the CFD for a single sgr file against every site index, saves the per site output and returns the normalised values
+#as {site file: [(normalised values, bootstrap interval or None, group profiles or None) of each window]}
+#(and the run statistics of the file if run_stats is set)
+#The sgr is read once and every site set uses the same chromosomes (and prefix index)
+#stream_index is the site index of every site file together (used to keep the bins near any site in streaming mode
+#and to find the parts of the file to read with a region index)
+def process_sgr_file(file, site_indexes, stream_index, args):
+    stats = RunStats(args.run_stats_memory) if args.run_stats is not None else None
+    sgr_cache = SgrCache(args.sgr_cache, args.sgr_cache_size) if args.sgr_cache is not None else None
+    name = os.path.basename(output_name(file))
     print (f'-----------------------------   \nCurrently working with {file} ')
     
-#Create paths and open files 
-    sgr_input = pd.read_csv('sgr_in\\' +file,delimiter='\t',header=None,names=['chr','site','reads'])
-    out_file = 'out//'+file
-    if normalised_out != '':
-        normalised_out = normalised_out +'___' +file
+    #Create paths and open files (compressed files are read directly, the outputs are named without the .gz/.bgz)
+    out_file = os.path.join(args.out_dir, name)
+
+    #Load the sgr into a hash table of chromosomes (from the cache if it has been parsed before)
+    sgr_path = file
+    sgr_region_index = SgrRegionIndex.load(sgr_path) if args.region_index else None
+    widest = max(window_bp + window_bin for window_bp, window_bin in args.windows) // stream_index.bin_size if stream_index is not None else None
+    if sgr_region_index is not None:
+        with run_phase(stats, name, 'load'):
+            chromosomes, bins_read, chromosomes_read = read_sgr_regions(sgr_path, stream_index, widest, sgr_region_index)
+    elif args.streaming:
+        with run_phase(stats, name, 'load'):
+            chromosomes, bins_read, chromosomes_read = read_sgr_near_sites(sgr_path, stream_index, widest, chunksize=args.chunk_size, threads=args.decompress_threads)
+    elif sgr_cache is not None:
+        with run_phase(stats, name, 'load'):
+            chromosomes = sgr_cache.load(sgr_path, threads=args.decompress_threads)
+        bins_read = sum(positions.size for positions, reads in chromosomes.values())
+        chromosomes_read = len(chromosomes)
     else:
-        normalised_out = normalised_out +file
-    #Forward and reverse strands made into opposite index arrays (121 is the 0 value)
-    #columns are specific genes, rows are reads at a particular distance from the site of that gene 
-    #First put into a list of Series as list.append is much more effiecent than pd.concat
-    collection_F = []
-    collection_R = []  
-    
-    
-    print (f'''Contains {sgr_input.chr.count()} bin values
-Contains {len(sgr_input.loc[:,'chr'].unique())} chromosomes ''')
-    
-    #Changing the chromosome slices to within a hash table 
-    chromosomes={}
-    for chrom in sgr_input.chr.unique():
-        chromosomes.update({chrom:sgr_input[sgr_input.chr== chrom]})
-
-    #Iterate over each gene in site_input and find its location in the sgr file
-             
-    for gene_index in range(site_input.index.size):
-        # print ('working with {} at number {}/{}'.format(site_input.iloc[gene_index,1],gene_index,site_input.index.size))    #Use while still slow
-        
-        
-    #Specify which chromosome the current gene uses  
-        specific_chr = chromosomes[site_input.iloc[gene_index,0]]
-        
-        
-        ## Get the index for the site within the specified chromosome indices 
-        
-        index_reads = specific_chr.index[specific_chr.site == site_input.iloc[gene_index,2]]        
-        
-        #Create a series with number of reads corresponding to the distance from the site (-1200 is index 0, 0 is index 121, 1200 is index 240)
-     
-        bin_reads = pd.Series(specific_chr.loc[index_reads[0]-120:index_reads[0]+120,'reads'])    
-        
-        bin_reads.name = site_input.iloc[gene_index,1]              #Make the column the genes name 
-        
-        #Concatinate bin_reads collumns with the appropriate collection (forward or reverse strand)
-        if site_input.iloc[gene_index,3] == 'F':
-            # bin_reads.index = range(1200,-1210,-10)               #Used if index specified in original
-            collection_F.append(bin_reads.reset_index(drop=True))
-        elif site_input.iloc[gene_index,3] == 'R':
-            # bin_reads.index = range(-1200,+1210,10)               #Used if index specified in original
-            collection_R.append(bin_reads.reset_index(drop=True))
+        with run_phase(stats, name, 'parse'):
+            sgr_input = read_sgr(sgr_path, threads=args.decompress_threads)
+        print(parse_rate(sgr_input))
+        with run_phase(stats, name, 'split'):
+            chromosomes = split_chromosomes(sgr_input)
+        bins_read = sgr_input.chr.count()
+        chromosomes_read = len(chromosomes)
+    print (f'''Contains {bins_read} bin values
+Contains {chromosomes_read} chromosomes 
+Uses {memory_footprint(chromosomes) / 1024**2:.1f} MB in memory ''')
+
+    #Find every site in the sgr file at once and gather the +/-120 bin window for each into a single matrix
+    #Columns of final are specific genes, rows are reads at a particular distance from the site of that gene 
+    #Any other windows are made from the prefix sum index which is only built once for the file
+    #With chromosome_workers the lookup of every site set and window is split by chromosome across one process pool
+    #(each worker makes its own prefix sums for the chromosomes it is given)
+    prefix_index = None
+    all_sites = {}
+    chromosome_pool = None
+    if args.chromosome_workers != 1:
+        with run_phase(stats, name, 'shared_memory'):
+            chromosome_pool = ChromosomePool(chromosomes, args.chromosome_workers or None)
+    with chromosome_pool if chromosome_pool is not None else nullcontext():
+        for site_file, site_index in site_indexes.items():
+            all_windows = []
+            for window_bp, window_bin in args.windows:
+                if window_bin != site_index.bin_size and prefix_index is None and chromosome_pool is None:
+                    with run_phase(stats, name, 'prefix_index'):
+                        prefix_index = PrefixIndex(chromosomes)
+                final, after_sum_normalised, total_reads, normalisation = cfd_for_window(chromosomes, site_index, name, window_bp, window_bin, prefix_index, stats=stats, chromosome_pool=chromosome_pool)
+                print(f'{site_file} +/-{window_bp}bp in {window_bin}bp bins: The total amount of reads are {total_reads}\nThe normalisation number is {normalisation}')
+                #Save the file output (Temp) (written a block of rows at a time)
+                with run_phase(stats, name, 'write'):
+                    write_table(final, out_file + site_suffix(site_file, site_indexes) + window_suffix(window_bp, window_bin, args.windows) + OUTPUT_FORMATS[args.output_format], args.output_format, sites_as_rows=True)     ###
+                # np.savetxt(out_file,final,delimiter='\t',fmt='%s')
+                interval = None
+                if args.bootstrap:
+                    with run_phase(stats, name, 'bootstrap'):
+                        interval = bootstrap_cfd(final, args.bootstrap, args.confidence, args.seed, args.bootstrap_workers)
+                    interval.columns = [f'{name}_lower', f'{name}_upper']
+                #The profile of each group of sites comes from the same per site matrix
+                grouped = None
+                if args.groups:
+                    with run_phase(stats, name, 'groups'):
+                        grouped = cfd_by_group(final, site_index, name)
+                all_windows.append((after_sum_normalised, interval, grouped))
+            all_sites[site_file] = all_windows
+
+    return all_sites, stats.records if stats is not None else []
+
+
+#Output file name for an sgr file (without the compression extension so the name matches the file inside)
+def output_name(file):
+    for extension in SGR_COMPRESSION:
+        if file.endswith(extension):
+            return file[:-len(extension)]
+    return file
+
+
+#The first window keeps the original output names, the others have the window and bin size added
+def window_suffix(window_bp, window_bin, windows):
+    return '' if (window_bp, window_bin) == windows[0] else f'_{window_bp}bp_{window_bin}bp'
+
+
+#A single site file keeps the original output names, with more than one the site file name is added
+def site_suffix(site_file, site_indexes):
+    if len(site_indexes) == 1:
+        return ''
+    site_name = os.path.basename(site_file)
+    for extension in SGR_COMPRESSION:
+        if site_name.endswith(extension):
+            site_name = site_name[:-len(extension)]
+    return '_' + os.path.splitext(site_name)[0]
+
+
+#The site indexes and settings are sent to each worker once when the pool starts rather than with every file
+def init_worker(shared_site_indexes, shared_stream_index, shared_args):
+    global worker_site_indexes, worker_stream_index, worker_args
+    worker_site_indexes = shared_site_indexes
+    worker_stream_index = shared_stream_index
+    worker_args = shared_args
+
+
+def process_sgr_file_in_worker(file):
+    return process_sgr_file(file, worker_site_indexes, worker_stream_index, worker_args)
+
+
+#sgr files to use (the ones given with --sgr or every sgr file in the sgr folder) and the same for the site files
+#Returned as paths (--sgr and --sites are used as given), the outputs are named from the file names only
+def find_files(args):
+    sgr_files = args.sgr if args.sgr else sorted(os.path.join(args.sgr_dir, file) for file in os.listdir(args.sgr_dir) if output_name(file).endswith('.sgr'))
+    site_files = args.sites if args.sites else sorted(os.path.join(args.site_dir, file) for file in os.listdir(args.site_dir) if not file.startswith('.'))
+    return sgr_files, site_files
+
+
+#open site files rounded to the nearest multiple of 10 (rounding method chosen above)
+#Each site index is built once here and reused for every sgr file
+#Also returns the site index used for streaming and the region index (the bins near the sites of any of the site files)
+def load_site_indexes(site_files, args, stats=None):
+    site_indexes = {}
+    for site_file in site_files:
+        with run_phase(stats, site_file, 'site_index'):
+            site_indexes[site_file] = SiteIndex.from_file(site_file, bin_size=args.bin_size, rounding=args.rounding, cache_dir=args.site_index_cache)
+
+        print(f'''The site file {site_file} is being used
+Contains: {site_indexes[site_file].forward.sum()} Forward strands and {site_indexes[site_file].reverse.sum()} Reverse strands ''')
+        if args.groups and site_indexes[site_file].groups is None:
+            raise SystemExit(f'The site file {site_file} has no group column (a 5th column after the strand) for --groups')
+
+    stream_index = None
+    if args.streaming and args.sgr_cache is not None:
+        print('Streaming is used so the sgr cache is not (only the bins near the sites are read)')
+    if args.streaming or args.region_index:
+        if len(site_files) == 1:
+            stream_index = site_indexes[site_files[0]]
         else:
-            print('Encountered strand direction that is not F or R, this gene will be skipped')
-            # break
+            stream_index = SiteIndex(pd.concat([read_sites(site_file) for site_file in site_files]), args.bin_size, args.rounding)
 
-    #Convert the two collections(lists) of Series to a DataFrame and transpose it 
-    collection_F = pd.DataFrame(collection_F).T
-    collection_R = pd.DataFrame(collection_R).T
-    #Combine the two reads (opposite assignment results in reads being assigned for correct strand 
-    
-    collection_F.index=range(-1200,1210,10)
-    collection_R.index=range(1200,-1210,-10)
-    final = pd.concat([collection_F,collection_R],axis=1)
-    #Do sum and normalise 
-    total_reads = final.sum(axis=1).sum()
-    normalisation=total_reads/241
-    after_sum_normalised =final.sum(axis=1)/normalisation
-    after_sum_normalised.name=file
-    print(f'The total amount of reads are {total_reads}\nThe normalisation number is {normalisation}')
-    #Save the file output (Temp) 
-    final.to_csv(out_file,sep='\t')                                 ###
-    # after_sum_normalised.to_csv(normalised_out,sep='\t')
-    all_normalised_together = pd.concat([all_normalised_together,after_sum_normalised],axis=1)
-    # np.savetxt(out_file,final,delimiter='\t',fmt='%s')
-    
-all_normalised_together.to_csv('out//normalised_' + normalised_out,sep='\t')   
-print('Finished')
\ No newline at end of file
+    return site_indexes, stream_index
+
+
+#One normalised table per site file and window (all the files together), all_results are the results of process_sgr_file
+#in the order of the columns and the tables are named normalised..._{combined_name} (written with write)
+def write_normalised(all_results, site_files, site_indexes, combined_name, args, stats=None, write=write_table):
+    for site_file in site_files:
+        for number, (window_bp, window_bin) in enumerate(args.windows):
+            window_normalised = [file_sites[site_file][number][0] for file_sites, file_stats in all_results]
+            with run_phase(stats, 'normalised', 'concat'):
+                all_normalised_together = pd.concat(window_normalised, axis=1) if window_normalised else pd.DataFrame()
+            with run_phase(stats, 'normalised', 'write'):
+                out_name = site_suffix(site_file, site_indexes) + window_suffix(window_bp, window_bin, args.windows) + '_' + combined_name + OUTPUT_FORMATS[args.output_format]
+                write(all_normalised_together, os.path.join(args.out_dir, 'normalised' + out_name), args.output_format)
+
+                #The bootstrap interval of every sgr file next to the normalised table
+                if args.bootstrap:
+                    intervals = [file_sites[site_file][number][1] for file_sites, file_stats in all_results]
+                    write(pd.concat(intervals, axis=1) if intervals else pd.DataFrame(), os.path.join(args.out_dir, 'normalised_ci' + out_name), args.output_format)
+
+                #The profile of each group of sites of every sgr file as one tidy table
+                if args.groups:
+                    grouped = [file_sites[site_file][number][2] for file_sites, file_stats in all_results]
+                    write(pd.concat(grouped).set_index('library') if grouped else pd.DataFrame(), os.path.join(args.out_dir, 'normalised_groups' + out_name), args.output_format)
+
+
+#Size and modified time of a file (None if it has gone)
+def file_signature(path):
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return stat.st_size, stat.st_mtime_ns
+
+
+#Watch mode, checks the folders every args.watch seconds and only runs the sgr files that are new or have changed
+#(every file is rerun if a site file or the settings change). The result of each file is kept in out_dir/watch_results
+#so a restart carries on where it left off, and after any change the normalised tables of every file are rewritten
+#as normalised..._all (to a temporary file that is then renamed, so the table is never seen half written)
+#A file is only used once its size and modified time are the same on two checks in a row (i.e. it has finished copying)
+#Site files that can't be loaded are reported and the last ones that could are kept until they change again
+def watch_folders(args):
+    results_dir = os.path.join(args.out_dir, 'watch_results')
+    os.makedirs(results_dir, exist_ok=True)
+    settings = repr((args.windows, args.rounding, args.bin_size, args.output_format, args.bootstrap, args.confidence, args.seed, args.groups))
+    previous_signatures = {}
+    site_key = None
+    failed_site_key = None
+    written = {}
+    failed = {}
+    print(f'Watching {args.sgr_dir} and {args.site_dir} every {args.watch} seconds (Ctrl+C to stop)')
+
+    while True:
+        sgr_files, site_files = find_files(args)
+        signatures = {path: file_signature(path) for path in sgr_files + site_files}
+        settled = {path for path, signature in signatures.items() if signature is not None and previous_signatures.get(path) == signature}
+        previous_signatures = signatures
+
+        #Nothing is run while a site file is being copied in (or until the site files have loaded once)
+        sites_settled = site_files and all(file in settled for file in site_files)
+        if sites_settled:
+            new_site_key = SgrCache.key_for_bytes(settings + ''.join(SgrCache.key_for_file(file) for file in site_files))
+            if new_site_key not in (site_key, failed_site_key):
+                try:
+                    site_indexes, stream_index = load_site_indexes(site_files, args)
+                except (Exception, SystemExit) as error:
+                    print(f'The site files could not be loaded: {error}' + (' (using the last ones that could)' if site_key is not None else ''))
+                    failed_site_key = new_site_key
+                else:
+                    loaded_site_files = site_files
+                    site_key = new_site_key
+                    written = {}
+
+        if sites_settled and site_key is not None:
+            #Results kept from before (for the current site files and settings) and the files that need running
+            file_keys = {}
+            file_results = {}
+            to_run = []
+            for file in sgr_files:
+                #A file that is being changed keeps its last result until it has settled
+                if file not in settled:
+                    if file in written:
+                        file_keys[file], file_results[file] = written[file]
+                    continue
+                key = SgrCache.key_for_bytes(site_key + SgrCache.key_for_file(file))
+                file_keys[file] = key
+                try:
+                    with open(os.path.join(results_dir, os.path.basename(output_name(file)) + '.pkl'), 'rb') as handle:
+                        stored_key, file_sites = pickle.load(handle)
+                except (OSError, EOFError, pickle.UnpicklingError):
+                    stored_key = None
+                if stored_key == key:
+                    file_results[file] = file_sites
+                elif failed.get(file) != key:
+                    to_run.append(file)
+
+            #Only the new or changed files are run (in the process pool if there is more than one and workers isn't 1)
+            #and a file that fails is tried again once it changes
+            pool = None
+            if args.workers != 1 and len(to_run) > 1:
+                pool = ProcessPoolExecutor(max_workers=args.workers or None, initializer=init_worker, initargs=(site_indexes, stream_index, args))
+                futures = {file: pool.submit(process_sgr_file_in_worker, file) for file in to_run}
+            for file in to_run:
+                try:
+                    file_sites, file_stats = futures[file].result() if pool is not None else process_sgr_file(file, site_indexes, stream_index, args)
+                except Exception as error:
+                    print(f'{file} failed: {error}')
+                    failed[file] = file_keys[file]
+                    continue
+                with open(os.path.join(results_dir, os.path.basename(output_name(file)) + '.pkl'), 'wb') as handle:
+                    pickle.dump((file_keys[file], file_sites), handle, protocol=pickle.HIGHEST_PROTOCOL)
+                file_results[file] = file_sites
+            if pool is not None:
+                pool.shutdown()
+
+            #The combined tables are only rewritten when a file has been added, changed or removed
+            done = {file: (file_keys[file], file_results[file]) for file in sgr_files if file in file_results}
+            if [(file, key) for file, (key, file_sites) in done.items()] != [(file, key) for file, (key, file_sites) in written.items()]:
+                #(a table that can't be written is tried again after the next change)
+                try:
+                    write_normalised([(file_sites, []) for key, file_sites in done.values()], loaded_site_files, site_indexes, 'all', args, write=replace_table)
+                except Exception as error:
+                    print(f'The normalised tables could not be written: {error}')
+                else:
+                    print(f'{time.strftime("%H:%M:%S")} Normalised tables updated with {len(done)} sgr files ({len(to_run)} run)')
+                written = done
+
+        time.sleep(args.watch)
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    os.makedirs(args.out_dir, exist_ok=True)
+
+    if args.watch is not None:
+        try:
+            watch_folders(args)
+        except KeyboardInterrupt:
+            print('Stopped watching')
+        raise SystemExit
+
+    #Find the files 
+    sgr_files, site_files = find_files(args)
+    normalised_out = '___'.join(os.path.basename(output_name(file)) for file in sgr_files)      #Idea is to make end normalised file all the files together
+
+    stats = RunStats(args.run_stats_memory) if args.run_stats is not None else None
+
+    site_indexes, stream_index = load_site_indexes(site_files, args, stats)
+
+    #Each file is independent until they are all put together so they can be run in parallel
+    #(map returns the results in the original file order)
+    if args.workers == 1:
+        all_results = [process_sgr_file(file, site_indexes, stream_index, args) for file in sgr_files]
+    else:
+        with ProcessPoolExecutor(max_workers=args.workers or None, initializer=init_worker, initargs=(site_indexes, stream_index, args)) as pool:
+            all_results = list(pool.map(process_sgr_file_in_worker, sgr_files))
+    if stats is not None:
+        for file_sites, file_stats in all_results:
+            stats.records.extend(file_stats)
+
+    write_normalised(all_results, site_files, site_indexes, normalised_out, args, stats)
+
+    #Save the run statistics and show the total time of each phase
+    if stats is not None:
+        stats.save(args.run_stats)
+        print(stats.to_frame().groupby('phase', sort=False)[['seconds', 'peak_mb']].agg({'seconds': 'sum', 'peak_mb': 'max'}))
+    print('Finished')